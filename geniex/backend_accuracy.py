@@ -0,0 +1,60 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+import src.config as cfg
+
+# Accuracy (and speed) of the CPU GENIEx backends (cfg.geniex_backend: 'script') against the fp32 model,
+# on the crossbar inputs stored by the GENIEx dataset collection (cfg.dataset = True, see geniex/mvm_dataset.py).
+# Run from the repository root:
+#   python -m geniex.backend_accuracy --xbmodel_weight_path xb_models/XB_32_stream1slice2.pth.tar --xbar_size 32
+parser = argparse.ArgumentParser(description='GENIEx backend accuracy check')
+parser.add_argument('--xbmodel_weight_path', required=True, help='trained GENIEx (NN_model) checkpoint')
+parser.add_argument('--xbar_size', type=int, default=cfg.xbar_row_size, help='crossbar size N of the model and dataset')
+parser.add_argument('--bit_stream', type=int, default=cfg.bit_stream)
+parser.add_argument('--bit_slice', type=int, default=cfg.bit_slice)
+parser.add_argument('--direc', default=cfg.direc, help='folder containing the geniex dataset')
+parser.add_argument('--max_rows', type=int, default=100000, help='dataset rows (crossbar inputs) to evaluate')
+parser.add_argument('--batch_size', type=int, default=cfg.geniex_chunk_size if cfg.geniex_chunk_size > 0 else 2048)
+parser.add_argument('--backends', default='script')
+args = parser.parse_args()
+
+N = args.xbar_size
+name = str(N)+'stream'+str(args.bit_stream)+'slice'+str(args.bit_slice)
+direc = args.direc+'/spice_'+str(N)+'_stream'+str(args.bit_stream)+'slice'+str(args.bit_slice)+'_all_layers'
+V = np.loadtxt(direc+'/dataset_V_'+name+'.txt', delimiter=',', max_rows=args.max_rows, ndmin=2)
+G = np.loadtxt(direc+'/dataset_G_'+name+'.txt', delimiter=',', max_rows=args.max_rows, ndmin=2)
+# same scaling as the simulator (mvm_tensor_nonid, program_conductance)
+V_scaled = torch.from_numpy(V).float()/cfg.Vmax
+G_scaled = (torch.from_numpy(G).float()-cfg.Goff)/(cfg.Gon-cfg.Goff)
+print('==> GENIEx dataset:', direc, V_scaled.shape[0], 'rows')
+
+model = cfg.NN_model(N)
+model.load_state_dict(torch.load(args.xbmodel_weight_path, map_location='cpu')['state_dict'])
+model.eval()
+in_diff = cfg.inmax_test-cfg.inmin_test
+
+def run(fn):
+    out = []
+    start = time.time()
+    with torch.no_grad():
+        for i in range(0, V_scaled.shape[0], args.batch_size):
+            out.append(fn(G_scaled[i:i+args.batch_size], V_scaled[i:i+args.batch_size]))
+    return torch.cat(out), time.time()-start
+
+# split: conductance half of fc1 (once per crossbar in the simulator, fp32 in every backend) + forward_split
+full_ref, full_time = run(lambda g, v: model(torch.cat((g, v), 1)))
+split_ref, split_time = run(lambda g, v: model.forward_split(model.project_conductance(g), v))
+print('fp32      full %.3fs  split %.3fs' % (full_time, split_time))
+
+for backend in args.backends.split(','):
+    xbmodel = cfg.NN_model_inference(model, backend)
+    full, full_time = run(lambda g, v: xbmodel(torch.cat((g, v), 1)))
+    split, split_time = run(lambda g, v: xbmodel.forward_split(xbmodel.project_conductance(g), v))
+    for path, out, ref, t in [('full', full, full_ref, full_time), ('split', split, split_ref, split_time)]:
+        err = (out-ref).abs()
+        # relative error of the unscaled ratio = relative error of the simulated column currents (ADC inputs)
+        rel = err*in_diff/(ref*in_diff+cfg.inmin_test).abs()
+        print('%-9s %-5s %.3fs  niratio abs err max %.3e mean %.3e  current rel err max %.3e mean %.3e' %
+              (backend, path, t, err.max().item(), err.mean().item(), rel.max().item(), rel.mean().item()))
@@ -3,7 +3,16 @@ import torch
 import torch.nn.functional as F
 import sys
 import time
-from src.pytorch_mvm_class_v2 import *
+
+import config as cfg
+
+if cfg.if_bit_slicing and not cfg.dataset:
+    from src.pytorch_mvm_class_v3 import *
+elif cfg.dataset:
+    from geneix.pytorch_mvm_class_dataset import *   # import mvm class from geneix folder
+else:
+    from src.pytorch_mvm_class_no_bitslice import *
+from src.layer_cache import cached
 __all__ = ['net']
 
 
@@ -12,6 +21,7 @@ class resnet(nn.Module):
 
     def __init__(self):
         super(resnet, self).__init__()
+        self.layer_cache = None # LayerOutputCache of the stage outputs (src/layer_cache.py), None to compute every stage
 
     def forward(self, x):
         t = time.time()
@@ -83,6 +93,16 @@ class resnet(nn.Module):
         # t1 = time.time()
         # print('Time taken: ',t1-t)
         # pdb.set_trace()
+        # stage outputs are cache points (src/layer_cache.py): with a layer_cache, a stage whose upstream
+        # configuration is unchanged is read from the cache instead of recomputed
+        out = cached(self, 'stage4', lambda: self.stage4(cached(self, 'stage3', lambda: self.stage3(cached(self, 'stage2', lambda: self.stage2(cached(self, 'stage1', lambda: self.stage1(x))))))))
+        x = self.classifier(out)
+        t5 = time.time()
+        print('Total Time taken: ',t5-t)
+
+        return x
+
+    def stage1(self, x):
         x = self.conv1(x)
         print('Conv1: ', torch.mean(x))
         x = self.bn1(x)
@@ -109,6 +129,9 @@ class resnet(nn.Module):
         out = self.bn5(out)
         out+=residual1
         out = F.relu(out)
+        return out
+
+    def stage2(self, out):
         residual1 = out.clone() 
         ################################### 
         #########Layer################ 
@@ -132,6 +155,9 @@ class resnet(nn.Module):
         out = self.bn9(out)
         out+=residual1
         out = F.relu(out)
+        return out
+
+    def stage3(self, out):
         residual1 = out.clone() 
         ################################### 
         #########Layer################ 
@@ -155,6 +181,9 @@ class resnet(nn.Module):
         out = self.bn13(out)
         out+=residual1
         out = F.relu(out)
+        return out
+
+    def stage4(self, out):
         residual1 = out.clone() 
         ################################### 
         #########Layer################ 
@@ -178,9 +207,9 @@ class resnet(nn.Module):
         out = self.bn17(out)
         out+=residual1
         out = F.relu(out)
-        residual1 = out.clone() 
-        ################################### 
-        #########Layer################ 
+        return out
+
+    def classifier(self, out):
         x=out 
         x = self.avgpool(x)
 
@@ -195,8 +224,6 @@ class resnet(nn.Module):
         x = self.bn19(x)
 
         x = self.logsoftmax(x)
-        t5 = time.time()
-        print('Total Time taken: ',t5-t)
 
         return x
 
@@ -313,98 +340,98 @@ class ResNet_imagenet(resnet):
         ibit_total = 8
         bit_slice_in = 4
         bit_stream_in = 4
-        self.conv1=Conv2d_mvm(3,int(64*self.inflate), kernel_size=7, stride=2, padding=3,bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv1=Conv2d_mvm(3,int(64*self.inflate), kernel_size=7, stride=2, padding=3,bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn1= nn.BatchNorm2d(int(64*self.inflate))
         self.relu1=nn.ReLU(inplace=True)
         self.maxpool=nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.conv2=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv2=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn2= nn.BatchNorm2d(int(64*self.inflate))
         self.relu2=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv3=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv3=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn3= nn.BatchNorm2d(int(64*self.inflate))
         self.relu3=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv4=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv4=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn4= nn.BatchNorm2d(int(64*self.inflate))
         self.relu4=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv5=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv5=Conv2d_mvm(int(64*self.inflate), int(64*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn5= nn.BatchNorm2d(int(64*self.inflate))
         self.relu5=nn.ReLU(inplace=True)
         #######################################################
 
         #########Layer################ 
-        self.conv6=Conv2d_mvm(int(64*self.inflate), int(128*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv6=Conv2d_mvm(int(64*self.inflate), int(128*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn6= nn.BatchNorm2d(int(128*self.inflate))
-        self.resconv1=nn.Sequential(Conv2d_mvm(int(64*self.inflate), int(128*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False),
+        self.resconv1=nn.Sequential(Conv2d_mvm(int(64*self.inflate), int(128*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24),
         nn.BatchNorm2d(int(128*self.inflate)),
         nn.ReLU(inplace=True),)
         self.relu6=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv7=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv7=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn7= nn.BatchNorm2d(int(128*self.inflate))
         self.relu7=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv8=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv8=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn8= nn.BatchNorm2d(int(128*self.inflate))
         self.relu8=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv9=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv9=Conv2d_mvm(int(128*self.inflate), int(128*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn9= nn.BatchNorm2d(int(128*self.inflate))
         self.relu9=nn.ReLU(inplace=True)
         #######################################################
 
         #########Layer################ 
-        self.conv10=Conv2d_mvm(int(128*self.inflate), int(256*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv10=Conv2d_mvm(int(128*self.inflate), int(256*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn10= nn.BatchNorm2d(int(256*self.inflate))
-        self.resconv2=nn.Sequential(Conv2d_mvm(int(128*self.inflate), int(256*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False),
+        self.resconv2=nn.Sequential(Conv2d_mvm(int(128*self.inflate), int(256*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24),
         nn.BatchNorm2d(int(256*self.inflate)),
         nn.ReLU(inplace=True),)
         self.relu10=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv11=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv11=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn11= nn.BatchNorm2d(int(256*self.inflate))
         self.relu11=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv12=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv12=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn12= nn.BatchNorm2d(int(256*self.inflate))
         self.relu12=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv13=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv13=Conv2d_mvm(int(256*self.inflate), int(256*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn13= nn.BatchNorm2d(int(256*self.inflate))
         self.relu13=nn.ReLU(inplace=True)
         #######################################################
 
         #########Layer################ 
-        self.conv14=Conv2d_mvm(int(256*self.inflate), int(512*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv14=Conv2d_mvm(int(256*self.inflate), int(512*self.inflate), kernel_size=3, stride=2, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn14= nn.BatchNorm2d(int(512*self.inflate))
-        self.resconv3=nn.Sequential(Conv2d_mvm(int(256*self.inflate), int(512*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False),
+        self.resconv3=nn.Sequential(Conv2d_mvm(int(256*self.inflate), int(512*self.inflate), kernel_size=1, stride=2, padding=0, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24),
         nn.BatchNorm2d(int(512*self.inflate)),
         nn.ReLU(inplace=True),)
         self.relu14=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv15=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv15=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn15= nn.BatchNorm2d(int(512*self.inflate))
         self.relu15=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv16=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv16=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn16= nn.BatchNorm2d(int(512*self.inflate))
         self.relu16=nn.ReLU(inplace=True)
         #######################################################
 
-        self.conv17=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind=ind, loop=False)
+        self.conv17=Conv2d_mvm(int(512*self.inflate), int(512*self.inflate), kernel_size=3, stride=1, padding=1, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn17= nn.BatchNorm2d(int(512*self.inflate))
         self.relu17=nn.ReLU(inplace=True)
         #######################################################
@@ -412,7 +439,7 @@ class ResNet_imagenet(resnet):
         #########Layer################ 
         self.avgpool=nn.AvgPool2d(7)
         self.bn18= nn.BatchNorm1d(int(512*self.inflate))
-        self.fc=Linear_mvm(int(512*self.inflate),num_classes, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24, ind = ind, loop = False)
+        self.fc=Linear_mvm(int(512*self.inflate),num_classes, bias=False, bit_slice=bit_slice_in, bit_stream=bit_stream_in, weight_bits=wbit_total, weight_bit_frac=wbit_frac, input_bits=ibit_total, input_bit_frac=ibit_frac, adc_bit=14, acm_bits=32, acm_bit_frac=24)
         self.bn19= nn.BatchNorm1d(1000)
         self.logsoftmax=nn.LogSoftmax()
 
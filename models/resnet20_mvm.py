@@ -13,6 +13,7 @@ elif cfg.dataset:
     from geneix.pytorch_mvm_class_dataset import *   # import mvm class from geneix folder
 else:
     from src.pytorch_mvm_class_no_bitslice import *
+from src.layer_cache import cached
 
 __all__ = ['net']
   
@@ -20,8 +21,15 @@ class resnet(nn.Module):
 
     def __init__(self):
         super(resnet, self).__init__()
+        self.layer_cache = None # LayerOutputCache of the stage outputs (src/layer_cache.py), None to compute every stage
 
     def forward(self, x):
+        # stage outputs are cache points (src/layer_cache.py): with a layer_cache, a stage whose upstream
+        # configuration is unchanged is read from the cache instead of recomputed
+        out = cached(self, 'stage3', lambda: self.stage3(cached(self, 'stage2', lambda: self.stage2(cached(self, 'stage1', lambda: self.stage1(x))))))
+        return self.classifier(out)
+
+    def stage1(self, x):
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu1(x)
@@ -52,6 +60,9 @@ class resnet(nn.Module):
         out = self.bn7(out)
         out+=residual
         out = self.relu7(out)
+        return out
+
+    def stage2(self, out):
         residual = out.clone() 
         ################################### 
         out = self.conv8(out)
@@ -80,6 +91,9 @@ class resnet(nn.Module):
         out = self.bn13(out)
         out+=residual
         out = self.relu13(out)
+        return out
+
+    def stage3(self, out):
         residual = out.clone() 
         ################################### 
         out = self.conv14(out)
@@ -108,9 +122,9 @@ class resnet(nn.Module):
         out = self.bn19(out)
         out+=residual
         out = self.relu19(out)
-        residual = out.clone() 
-        ################################### 
-        
+        return out
+
+    def classifier(self, out):
         x=out
         x = self.avgpool(x)
         x = x.view(x.size(0), -1)
@@ -62,64 +62,58 @@ class L1XbarUnstructured(prune.BasePruningMethod):
             mask: mask (tensor)
         """ 
 
-        # receives a column tensor and calculates sparsity when mapped to an xbar column
-        def _get_sparsity (col_t):
-            n = col_t.nelement()
-            extra_zeros = 0 if n == cfg.xbar_row_size else cfg.xbar_row_size - n
-            return float(torch.sum(col_t == 0.0) + extra_zeros) / float(cfg.xbar_row_size), extra_zeros
-
-        # receives a column tensor and implements logic to give number of params to prune
-        def _get_n_params_to_prune (col_t, threshold, xbar_strategy):
-            assert (xbar_strategy in ['static', 'dynamic']), "Unsupported xbar pruning strategy"
-            
-            sparsity, extra_zeros = _get_sparsity(col_t)
-            if (xbar_strategy == 'dynamic'):
-                sparsity_out = sparsity
+        assert (self.xbar_strategy in ['static', 'dynamic']), "Unsupported xbar pruning strategy"
+
+        # Modify mask for every xbar_column based on sparsity logic - all xbar columns at once: the matrix rows are split
+        # in blocks of xbar_row_size (the last one padded), sparsity and number of params to prune are computed per block
+        def _get_xbar_mask (weight_mat, num_row, num_col):
+            xbar_row_size = cfg.xbar_row_size
+            num_chunk = math.ceil(num_col/xbar_row_size)
+            # padded entries are +inf: never counted as zeros
+            blocks = torch.full((num_row, num_chunk*xbar_row_size), float('inf'), dtype=weight_mat.dtype, device=weight_mat.device)
+            blocks[:, :num_col] = torch.abs(weight_mat)
+            blocks = blocks.view(num_row, num_chunk, xbar_row_size)
+
+            # sparsity of an xbar column (padded entries count as zeros)
+            extra_zeros = torch.zeros(num_chunk, dtype=torch.long, device=weight_mat.device)
+            extra_zeros[-1] = num_chunk*xbar_row_size - num_col
+            sparsity = (torch.sum(blocks == 0.0, dim=2) + extra_zeros).double() / float(xbar_row_size)
+
+            if (self.xbar_strategy == 'dynamic'):
+                sparsity_out = sparsity.clone()
+                matched = torch.zeros_like(sparsity, dtype=torch.bool)
                 s = [1-1.0, 1-1.0/2, 1-1.0/4, 1-1.0/8, 1-1.0/16, 1-1.0/32]
-                if (sparsity >= s[1]-threshold*(s[1]-s[0]) and sparsity <= s[1]):
-                        sparsity_out = s[1]
-                elif (sparsity >= s[2]-threshold*(s[2]-s[1]) and sparsity <= s[2]):
-                        sparsity_out = s[2]
-                elif (sparsity >= s[3]-threshold*(s[3]-s[2]) and sparsity <= s[3]):
-                        sparsity_out = s[3]
-                elif (sparsity >= s[4]-threshold*(s[4]-s[3]) and sparsity <= s[4]):
-                        sparsity_out = s[4]
-                elif (sparsity >= s[5]-threshold*(s[5]-s[4]) and sparsity <= s[5]):
-                        sparsity_out = s[5]
-                assert (sparsity_out >= sparsity)
+                for i in range(1, len(s)):
+                    in_range = (sparsity >= s[i]-self.threshold*(s[i]-s[i-1])) & (sparsity <= s[i]) & ~matched
+                    sparsity_out[in_range] = s[i]
+                    matched |= in_range
+                assert (torch.all(sparsity_out >= sparsity))
             else:
-                sparsity_out = threshold
+                sparsity_out = torch.full_like(sparsity, self.threshold)
 
-            temp = int((sparsity_out*cfg.xbar_row_size))
-            if (temp < extra_zeros): # more zeros than required to start with
-                n_params_to_prune = 0
-            else:
-                n_params_to_prune = temp - extra_zeros
-            assert (n_params_to_prune >= 0 and n_params_to_prune<=col_t.nelement()), "Logic for number of parameters to prune is incorrect"
-            
-            return n_params_to_prune
+            # more zeros than required to start with -> nothing to prune
+            n_params_to_prune = torch.clamp(torch.trunc(sparsity_out*xbar_row_size).long() - extra_zeros, min=0)
+            assert (torch.all(n_params_to_prune <= xbar_row_size - extra_zeros)), "Logic for number of parameters to prune is incorrect"
 
-        # Modify mask for every xbar_column based on sparsity logic
-        def _get_xbar_mask (weight_mat, num_row, num_col):
+            # prune the n_params_to_prune lowest-magnitude weights of every xbar column: one topk per group of xbar columns
+            # with the same length (full, last) and number of params to prune (same topk as per xbar column, same ties)
             weight_mat_mask = (weight_mat != 0.0).float()
-            for i in range(num_row):
-                for j in range(math.ceil(num_col/cfg.xbar_row_size)):
-                    col_start = j*cfg.xbar_row_size
-                    col_end = (j+1)*cfg.xbar_row_size
-                    if (col_end > num_col):
-                        col_end = num_col
-
-                    xbar_col_wt = weight_mat[i, col_start:col_end]
-                    n_params_to_prune = _get_n_params_to_prune(xbar_col_wt, self.threshold, self.xbar_strategy)
-
+            num_full = num_col // xbar_row_size
+            for col_start, col_end, n_group in [(0, num_full*xbar_row_size, n_params_to_prune[:, :num_full]),
+                                                (num_full*xbar_row_size, num_col, n_params_to_prune[:, num_full:])]:
+                if (col_end == col_start):
+                    continue
+                xbar_col_wt = torch.abs(weight_mat[:, col_start:col_end]).reshape(n_group.nelement(), -1)
+                xbar_col_mask = weight_mat_mask[:, col_start:col_end].reshape(n_group.nelement(), -1).clone()
+                n_group = n_group.reshape(-1)
+                for n in torch.unique(n_group).tolist():
                     # Fix GPU Bugs - skip for n_params_to_prune = 0
-                    if (n_params_to_prune < 1):
+                    if (n < 1):
                         continue
-
-                    topk = torch.topk(
-                        torch.abs(xbar_col_wt).view(-1), k=n_params_to_prune, largest=False
-                    )
-                    weight_mat_mask[i, col_start:col_end].view(-1)[topk.indices] = 0.0
+                    sel = torch.nonzero(n_group == n).squeeze(1)
+                    topk = torch.topk(xbar_col_wt[sel], k=n, largest=False)
+                    xbar_col_mask[sel] = xbar_col_mask[sel].scatter_(1, topk.indices, 0.0)
+                weight_mat_mask[:, col_start:col_end] = xbar_col_mask.view(num_row, col_end-col_start)
 
             return weight_mat_mask
         
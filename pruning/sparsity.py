@@ -77,7 +77,7 @@ def sparsity_plot (s_tuple, path="./", save=True):
             break
         temp = fig.add_subplot(n1, n1, j)
         #temp.hist(s_tuple[1][key].numpy(), bins=20, density=True, label='matrix', histtype='bar', rwidth=1)
-        temp.hist(s_tuple[2][key].numpy(), bins=20, range=(0,1), density=False, label='xbar', histtype='bar', rwidth=0.2)
+        temp.hist(s_tuple[2][key].cpu().numpy(), bins=20, range=(0,1), density=False, label='xbar', histtype='bar', rwidth=0.2)
         #temp.set_xlabel('Sparsity')
         #temp.set_ylabel('Dist')
         temp.legend(prop={'size': 10})
@@ -103,58 +103,51 @@ def sparsity_metrics (model):
 
     Returns:
         tuple:
-            - int -- layer-level sparsity
-            - int -- matrix column-level sparsity
-            - int -- xbar column-level sparsity
+            - dict -- layer-level sparsity
+            - dict -- matrix column-level sparsity (tensor on the weight's device)
+            - dict -- xbar column-level sparsity (tensor on the weight's device)
 
     Remarks:
         For dataParallel models, pass model.module as arguments #TODO
+        Layers: nn.Conv2d, nn.Linear, Conv2d_mvm, Linear_mvm
     """
 
     layer_s, matrix_s, xbar_s = {}, {}, {}
 
     for name, module in model.named_modules():
 
-        # TODO: Add for Linear layer
-        
-        if isinstance(module, torch.nn.Conv2d):
-            weight = module.weight            
-            
+        # nn.Conv2d, nn.Linear and their functional simulator versions (Conv2d_mvm/Linear_mvm of any src/ variant)
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear)) or type(module).__name__ in ['Conv2d_mvm', 'Linear_mvm']:
+            weight = module.weight
+
+            ## zeros of the weight matrix (out_channels, in_channels*k*k) - the transpose of the matrix mapped to xbars,
+            ## computed on the weight's device
+            weight_zeros = (weight.detach().reshape(weight.shape[0], -1) == 0.0)
+            num_col, num_row = weight_zeros.shape
+
             ## layer-level sparsity
-            layer_sparsity = float(torch.sum(weight == 0)) / float(weight.nelement())
-
-            ## convert weight tensor to 2d matrix
-            weight_channels_out = weight.shape[0]
-            weight_channels_in = weight.shape[1]
-            weight_row = weight.shape[2]
-            weight_col = weight.shape[3]
-            length = weight_channels_in * weight_row * weight_col
-            weight_mat2d = weight.view(weight_channels_out, length).t()
-
-            ## Convert 2d matrix to xbars, including padding boundary tiles with zeros
-            xbar_row = math.ceil(weight_mat2d.shape[0]/cfg.xbar_row_size)
-            xbar_col = math.ceil(weight_mat2d.shape[1]/cfg.xbar_col_size)
-            weight_xbar = torch.zeros(xbar_row*cfg.xbar_row_size, xbar_col*cfg.xbar_col_size)
-            weight_xbar[:weight_mat2d.shape[0], :weight_mat2d.shape[1]] = weight_mat2d
-            xbars = weight_xbar.unfold(0,cfg.xbar_row_size, cfg.xbar_row_size).unfold(1, cfg.xbar_col_size, cfg.xbar_col_size)
-            assert (xbar_row == xbars.shape[0] and xbar_col == xbars.shape[1]), "xbars unfolding is incorrect"
-            
+            layer_sparsity = float(torch.sum(weight_zeros)) / float(weight.nelement())
+
+            ## zeros per xbar column i.e. per (matrix column, xbar row), the boundary tiles padded with zeros
+            ## (only the counts are padded, not the weights)
+            xbar_row = math.ceil(num_row/cfg.xbar_row_size)
+            xbar_col = math.ceil(num_col/cfg.xbar_col_size)
+            num_full = num_row // cfg.xbar_row_size
+            xbar_zeros = torch.full((xbar_col*cfg.xbar_col_size, xbar_row), cfg.xbar_row_size, dtype=torch.long, device=weight.device)
+            xbar_zeros[:num_col, :num_full] = torch.sum(weight_zeros[:, :num_full*cfg.xbar_row_size].reshape(num_col, num_full, cfg.xbar_row_size), 2)
+            if (num_full < xbar_row):
+                xbar_zeros[:num_col, num_full] = torch.sum(weight_zeros[:, num_full*cfg.xbar_row_size:], 1) + xbar_row*cfg.xbar_row_size - num_row
+
             ## matrix-level sparsity
-            weight_xbar_z = torch.zeros(weight_xbar.shape) # view creates references i.e. no memory replication
-            weight_xbar_nz = torch.ones(weight_xbar.shape)
-            matrix_sparsity = torch.where(weight_xbar==0.0, weight_xbar_nz, weight_xbar_z)
-            matrix_sparsity = torch.sum(matrix_sparsity, 0) / weight_xbar.shape[0] #reduce acorss rows of the matrix
+            matrix_sparsity = torch.sum(xbar_zeros, 1).float() / (xbar_row*cfg.xbar_row_size) #reduce acorss rows of the matrix
 
-            ## xbar-level sparsity
-            xbars_z = torch.zeros(xbars.shape)
-            xbars_nz = torch.ones(xbars.shape)
-            xbars_sparsity = torch.where(xbars==0.0, xbars_nz, xbars_z)
-            xbars_sparsity = torch.sum(xbars_sparsity, 2)/ xbars.shape[2] #reduce across rows in one crossbar (xbar_row_size)
+            ## xbar-level sparsity (xbar_row, xbar_col, xbar_col_size)
+            xbars_sparsity = xbar_zeros.t().float() / cfg.xbar_row_size
 
             ## collect stats
             layer_s.update({name: layer_sparsity})
             matrix_s.update({name: matrix_sparsity})
-            xbar_s.update({name: xbars_sparsity.view(-1)})
+            xbar_s.update({name: xbars_sparsity.reshape(-1)})
 
     return layer_s, matrix_s, xbar_s
 
@@ -2,6 +2,9 @@ import torch.nn as nn
 import torch
 import torch.nn.functional as F
 import os
+import copy
+import json
+import hashlib
 
 if_bit_slicing = True
 debug = True
@@ -41,11 +44,26 @@ xbar_col_size = 16
 bit_stream = 1
 bit_slice = 2
 adc_bit = 14
+adc_per_column = False # ADC resolution per crossbar column: adc_bit reduced by 0..5 bits by the weight sparsity of the column (adc_stats buckets, pruning/sparsity.py)
 acm_bits = 32
 acm_bit_frac = 24
 
+## Simulator execution configurations
+batch_bit_stream = True # evaluate all input bit-streams in one crossbar op (bit_stream_num x the memory of a single stream)
+chunk_size = 4096 # (batch x output pixel) rows streamed through the xbars at once by Conv2d_mvm, <= 0 for the whole batch
+memory_budget = 0 # bytes of scratch memory per Conv2d_mvm/Linear_mvm forward; > 0 streams the batch in the largest micro-batches that fit (overrides chunk_size), 0 disables it
+int_engine = False # ideal xbars: fixed-point emulation in integer tensors (int8 bit-slices/bit-planes, int64 ADC codes and accumulators), exact fixed-point results (the float paths round where accumulators exceed a float32 mantissa)
+skip_zero_inputs = True # all-zero crossbar inputs (per xbar row and bit-plane) are not evaluated: their ADC codes are 0
+sparse_xbars = 0.5 # evaluate only the non-zero crossbars of layers with at most this fraction of crossbars occupied, 0 disables it
+sparse_xbar_storage = False # ideal float engine with batch_bit_stream: program the xbars straight into CSR matrices of their non-zero cells, no dense tensors
+
 ## GENIEx configurations
 loop = False # executes GENIEx with batching when set to False
+geniex_chunk_size = 2048 # max rows (crossbar x input pairs) per batched GENIEx model call, sized so the fc1 activations stay cache resident; <= 0 for a single call per layer
+geniex_memo_size = 0 # LRU memo of GENIEx ratios per layer, in (xbar row, input voltages) entries; 0 disables it (only for loop = False)
+geniex_backend = 'fp32' # GENIEx inference on CPU: 'fp32' (xbmodel as is) or 'script' (frozen TorchScript, bit-exact)
+# (NOTE) int8 dynamic quantization was evaluated and dropped: the per-input path (voltage half of fc1, add, ReLU, fc3) is
+# memory bound, so it ran ~20% slower than fp32 (16x16 non-ideal conv) and moved its outputs by up to ~0.5
 
 ## GENIEx data collection configuations
 dataset = False
@@ -68,6 +86,7 @@ class NN_model(nn.Module):
     def __init__(self, N):
          super(NN_model, self).__init__()
          print ("WARNING: crossbar sizes with different row annd column dimension not supported.")
+         self.N = N
          self.fc1 = nn.Linear(N**2+N, 500)
          # self.bn1 = nn.BatchNorm1d(500)
          self.relu1 = nn.ReLU(inplace=True)
@@ -80,6 +99,68 @@ class NN_model(nn.Module):
         # out = self.do2(out)
         out = self.fc3(out)
         return out
+    # fc1 split into its conductance half (first N**2 inputs) and voltage half (last N inputs). The conductance
+    # half only depends on the programmed crossbar, so the simulator computes it once per crossbar.
+    def project_conductance(self, g):
+        return F.linear(g, self.fc1.weight[:, :self.N**2], self.fc1.bias)
+    def project_voltage(self, v):
+        return F.linear(v, self.fc1.weight[:, self.N**2:])
+    def forward_projected(self, out): # forward() from the fc1 output
+        out = self.relu1(out)
+        out = self.fc3(out)
+        return out
+    def forward_split(self, g, v): # forward() from the conductance half of fc1 and the voltages (broadcast together)
+        return self.forward_projected(g + self.project_voltage(v))
+
+class NN_model_split(nn.Module):
+    # voltage half of fc1 -> add the conductance half -> ReLU -> fc3 of a NN_model, as one TorchScript-able graph
+    def __init__(self, model):
+        super(NN_model_split, self).__init__()
+        self.fc1_v_weight = nn.Parameter(model.fc1.weight.detach()[:, model.N**2:].clone())   # no nn.Linear: no random init (global RNG)
+        self.fc3 = copy.deepcopy(model.fc3)
+    def forward(self, g, v):
+        out = g + F.linear(v, self.fc1_v_weight)
+        out = torch.relu_(out) # in place, as relu1: one hidden-size buffer per call
+        return self.fc3(out)
+
+class NN_model_inference(nn.Module):
+    # CPU inference backend of a trained NN_model, with the same interface. Snapshot of the model weights:
+    # rebuild it after changing them. The conductance half of fc1 (once per crossbar) stays in fp32.
+    def __init__(self, model, backend):
+        super(NN_model_inference, self).__init__()
+        self.N = model.N
+        self.backend = backend
+        self.model = model
+        split = NN_model_split(model).eval()
+        full = copy.deepcopy(model).eval()
+        if backend == 'script':
+            # frozen where torch.jit.freeze is available (weights folded as constants), scripted otherwise
+            freeze = getattr(torch.jit, 'freeze', lambda module: module)
+            self.split = freeze(torch.jit.script(split))
+            self.full = freeze(torch.jit.script(full))
+        else:
+            raise ValueError('unknown GENIEx backend: ' + str(backend))
+    def forward(self, x):
+        return self.full(x)
+    def project_conductance(self, g):
+        return self.model.project_conductance(g)
+    def forward_split(self, g, v):
+        return self.split(g, v)
+
+inference_models = {} # id(xbmodel) -> (backend and parameter versions, NN_model_inference)
+def geniex_inference_model(model, backend=None):
+    # xbmodel run by the simulator for a GENIEx backend (cfg.geniex_backend by default). Built once per model and
+    # rebuilt when its parameters change (load_state_dict, training).
+    backend = geniex_backend if backend is None else backend
+    if backend == 'fp32' or model is None or not non_ideality:
+        return model
+    key = (backend,) + tuple((p.data_ptr(), p._version) for p in model.parameters())
+    entry = inference_models.get(id(model))
+    if entry is None or entry[0] != key or entry[1].model is not model:
+        with torch.no_grad():
+            entry = (key, NN_model_inference(model, backend))
+        inference_models[id(model)] = entry
+    return entry[1]
 
 #xbmodel = NN_model(xbar_row_size) #uncomment for FP16
 #xbmodel = NN_model(xbar_row_size) #uncomment for FP32
@@ -99,3 +180,42 @@ def dump_config():
         t_str = key + '=' + str(val)
         print (t_str, end=', ')
     print('\n')
+
+# Settings copied into each Conv2d_mvm/Linear_mvm at construction (the layer attributes are what the simulator uses)
+layer_configs = ('bit_slice', 'bit_stream', 'weight_bits', 'weight_bit_frac', 'input_bits', 'input_bit_frac',
+                 'adc_bit', 'acm_bits', 'acm_bit_frac', 'tile_row', 'tile_col')
+
+# Settings that only change how the simulator executes, not its results (bit-identical outputs). batch_bit_stream and
+# int_engine are not among them: the batched shift-add (float64) and the integer engine round differently from the
+# float32 bit-serial loop (float32 ulps, or more where the accumulators do not fit a float32 mantissa)
+exec_configs = ('debug', 'chunk_size', 'memory_budget', 'skip_zero_inputs', 'sparse_xbars', 'sparse_xbar_storage',
+                'geniex_chunk_size', 'geniex_memo_size')
+
+file_hashes = {} # path -> (size, mtime, sha1)
+def file_hash(path):
+    stat = os.stat(path)
+    entry = file_hashes.get(path)
+    if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime):
+        return entry[2]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    file_hashes[path] = (stat.st_size, stat.st_mtime, sha.hexdigest())
+    return file_hashes[path][2]
+
+# Per-layer settings of a Conv2d_mvm/Linear_mvm that determine its results: its layer_configs and its GENIEx checkpoint,
+# by content as config_hash does for the global one (None for the other modules)
+def layer_settings(layer):
+    path = getattr(layer, 'xbmodel_weight_path', None)
+    return [getattr(layer, key, None) for key in layer_configs] + [file_hash(path) if path is not None and os.path.isfile(path) else path]
+
+# Hash of everything that determines the simulator results: the global configurations (except exec_configs and exclude),
+# the GENIEx model weights, and extra (e.g. the model, its pretrained weights and per-layer settings in an evaluation run)
+def config_hash(extra=None, exclude=()):
+    param_dict = {key: val for key, val in globals().items() if not key.startswith('_') and key not in exec_configs + ('exec_configs', 'layer_configs')
+                  and key not in exclude and isinstance(val, (bool, int, float, str, tuple, list))}
+    if xbmodel_weight_path is not None and os.path.isfile(xbmodel_weight_path):
+        param_dict['xbmodel_weights'] = file_hash(xbmodel_weight_path)
+    param_dict['extra'] = extra
+    return hashlib.sha1(json.dumps(param_dict, sort_keys=True, default=str).encode()).hexdigest()[:16]
@@ -0,0 +1,119 @@
+import copy
+import fnmatch
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import src.config as cfg
+from src.pytorch_mvm_class_v3 import Conv2d_mvm, Linear_mvm
+
+## Conversion of a float model to the functional simulator: every nn.Conv2d/nn.Linear is replaced by a
+## Conv2d_mvm/Linear_mvm that holds the same Parameter objects (no copy of the weights), so any nn.Module
+## (models/*.py, torchvision models) is simulated without a hand-written *_mvm model file.
+## Per-layer simulator settings are selected by fnmatch patterns on the module names (model.named_modules()).
+
+# Per-layer settings that a layer config may set (the remaining ones come from src/config.py)
+mvm_layer_attrs = cfg.layer_configs + ('xbmodel', 'xbmodel_weight_path')
+
+def layer_config(name, layer_configs):
+    # Settings of module name: the entries of every matching pattern, merged in order (later patterns override).
+    # A pattern mapped to None keeps the matching layers in float, None is returned for them.
+    config = {}
+    for pattern, entry in (layer_configs.items() if isinstance(layer_configs, dict) else layer_configs):
+        if fnmatch.fnmatchcase(name, pattern):
+            if entry is None:
+                return None
+            unknown = set(entry) - set(mvm_layer_attrs)
+            if unknown:
+                raise ValueError('unknown layer settings {} for pattern {} (allowed: {})'.format(sorted(unknown), pattern, mvm_layer_attrs))
+            config.update(entry)
+    return config
+
+def mvm_layer(module, config, xbmodels=None):
+    # Conv2d_mvm/Linear_mvm sharing the parameters of module, None if the simulator does not support its settings.
+    # xbmodels: (id of xbmodel, checkpoint path) -> loaded copy, shares the per-layer GENIEx models across calls
+    if type(module) is nn.Conv2d:
+        if module.groups != 1 or module.dilation != (1, 1) or module.padding_mode != 'zeros' or isinstance(module.padding, str):
+            return None
+        layer = Conv2d_mvm(module.in_channels, module.out_channels, module.kernel_size, stride=module.stride,
+                           padding=module.padding, bias=module.bias is not None)
+    elif type(module) is nn.Linear:
+        layer = Linear_mvm(module.in_features, module.out_features, bias=module.bias is not None)
+    else:
+        return None
+    layer.weight = module.weight
+    if module.bias is not None:
+        layer.bias = module.bias
+    # explicit per-layer settings win over the ifglobal_* switches the constructors apply
+    for key, val in config.items():
+        setattr(layer, key, val)
+    if cfg.non_ideality and ('xbmodel' in config or 'xbmodel_weight_path' in config):
+        # the constructor loaded the global checkpoint into the global xbmodel: the layer's checkpoint is loaded
+        # into a copy of its xbmodel, so the layers of other patterns keep their own weights
+        assert (layer.xbmodel != None)
+        assert (layer.xbmodel_weight_path != None)
+        xbmodels = {} if xbmodels is None else xbmodels
+        key = (id(layer.xbmodel), layer.xbmodel_weight_path)
+        if key not in xbmodels:
+            xbmodel = copy.deepcopy(layer.xbmodel)
+            xbmodel.load_state_dict(torch.load(layer.xbmodel_weight_path)['state_dict'])
+            xbmodels[key] = xbmodel
+        layer.xbmodel = xbmodels[key]
+    layer.train(module.training)
+    return layer
+
+def convert_to_mvm(model, layer_configs=(), inplace=False):
+    """Replace the nn.Conv2d/nn.Linear modules of model by Conv2d_mvm/Linear_mvm sharing their parameters.
+
+    layer_configs: {pattern: settings} dict or list of (pattern, settings) pairs. The settings (keys of
+    cfg.layer_configs, xbmodel, xbmodel_weight_path) of every pattern matching a module name apply to that layer,
+    settings None keeps the matching layers in float. Grouped, dilated and non-zero-padded convolutions stay in
+    float as the simulator does not support them. Convolutions whose output map is not a multiple of the tile size
+    are converted: tiling only matters to the hardware model, and Conv2d_mvm warns about them.
+    Without inplace the float model is left unchanged: the converted model is a copy of its structure whose
+    parameters and buffers are the float model's tensors, so weight updates are seen by both.
+    With cfg.non_ideality, layers given their own xbmodel_weight_path get a copy of their xbmodel with that checkpoint.
+    Forward hooks of the converted layers are not carried over.
+    """
+    if not inplace:
+        memo = {id(t): t for t in list(model.parameters()) + list(model.buffers())}
+        model = copy.deepcopy(model, memo)
+    modules = dict(model.named_modules())
+    converted = {} # id of float module -> mvm layer (modules registered under several names are converted once)
+    xbmodels = {}
+    for name, module in list(modules.items()):
+        if type(module) not in (nn.Conv2d, nn.Linear):
+            continue
+        if id(module) not in converted:
+            config = layer_config(name, layer_configs)
+            converted[id(module)] = mvm_layer(module, config, xbmodels) if config is not None else None
+        layer = converted[id(module)]
+        if layer is None:
+            continue
+        if name == '':
+            return layer
+        parent, _, child = name.rpartition('.')
+        setattr(modules[parent], child, layer)
+    return model
+
+def check_conversion(model, input):
+    # Max |output - float output| of every Conv2d_mvm/Linear_mvm of a converted model on one forward of input, the float
+    # output being the conv/linear of the layer's own (shared) parameters on the same layer input. Ideal crossbars
+    # stay within the fixed-point error, a larger difference points at a layer the simulator does not map correctly.
+    errors = {}
+    def check(name):
+        def hook(layer, inputs, output):
+            if isinstance(layer, Conv2d_mvm):
+                ref = F.conv2d(inputs[0], layer.weight, layer.bias, layer.stride, layer.padding)
+            else:
+                ref = F.linear(inputs[0], layer.weight, layer.bias)
+            errors[name] = max(errors.get(name, 0), (output - ref).abs().max().item())
+        return hook
+    handles = [m.register_forward_hook(check(name)) for name, m in model.named_modules() if isinstance(m, (Conv2d_mvm, Linear_mvm))]
+    try:
+        with torch.no_grad():
+            model(input)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return errors
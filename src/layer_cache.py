@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+import src.config as cfg
+
+## Disk-backed cache of layer outputs for the prefix of a network whose configuration does not change across runs,
+## e.g. the first stages of a model while the crossbar configuration of the last stage is swept.
+## A cache point is a named intermediate output of a model forward (models/*_mvm.py call cached() at stage boundaries).
+## Its outputs are stored in a memory-mapped .npy array of [num_samples, ...] rows, indexed by dataset index, one array
+## per upstream configuration: the simulator globals (config_hash) and the settings, parameters and buffers of every
+## module evaluated to compute the point. A point is read from the cache when all the samples of the batch are there.
+## (NOTE) The model code itself is not part of the key - clear the cache folder after changing a model forward.
+
+class LayerOutputCache(object):
+
+    def __init__(self, cache_dir, num_samples, points=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.num_samples = num_samples
+        self.points = points        # names of the cached points, None for all
+        self.indices = None         # dataset indices of the current batch, set by the evaluation loop (None: bypass)
+        self.upstream = {}          # point -> names of the modules it depends on
+        self.weights = {}           # point -> (parameter versions, hash of the upstream parameters and buffers)
+        self.arrays = {}            # (point, config) -> (outputs, valid) memmaps
+        self.recording = []         # module names recorded by the points being computed
+        self.hits = 0
+        self.misses = 0
+
+    def upstream_modules(self, point):
+        if point not in self.upstream:
+            path = os.path.join(self.cache_dir, point + '.modules.json')
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                self.upstream[point] = json.load(f)
+        return self.upstream[point]
+
+    def upstream_config(self, model, point):
+        # config hash of a point: the simulator globals, the settings of its upstream modules and their parameters
+        # and buffers (hashed again only when one of them changes)
+        names = self.upstream_modules(point)
+        if names is None:
+            return None
+        modules = dict(model.named_modules())
+        if any(name not in modules for name in names):
+            return None
+        settings = [[name, type(modules[name]).__name__, modules[name].extra_repr(), modules[name].training] +
+                    cfg.layer_settings(modules[name]) for name in names]
+        tensors = [t for name in names for t in list(modules[name].parameters()) + list(modules[name].buffers())]
+        versions = tuple((t.data_ptr(), t._version) for t in tensors)
+        entry = self.weights.get(point)
+        if entry is None or entry[0] != versions:
+            sha = hashlib.sha1()
+            for name in names:
+                for key, tensor in modules[name].state_dict().items():
+                    sha.update((name + '.' + key).encode())
+                    sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+            entry = (versions, sha.hexdigest())
+            self.weights[point] = entry
+        return cfg.config_hash({'model': type(model).__name__, 'point': point, 'modules': settings, 'weights': entry[1]},
+                               exclude=cfg.layer_configs)
+
+    def open(self, point, config, output=None):
+        # (outputs, valid) memmaps of a point, created from the first output stored
+        key = (point, config)
+        if key not in self.arrays:
+            path = os.path.join(self.cache_dir, point + '-' + config)
+            if os.path.exists(path + '.npy'):
+                self.arrays[key] = (np.lib.format.open_memmap(path + '.npy', mode='r+'),
+                                    np.lib.format.open_memmap(path + '.valid.npy', mode='r+'))
+            elif output is not None:
+                dtype = output.detach().cpu().numpy().dtype
+                self.arrays[key] = (np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=dtype, shape=(self.num_samples,) + tuple(output.shape[1:])),
+                                    np.lib.format.open_memmap(path + '.valid.npy', mode='w+', dtype=np.uint8, shape=(self.num_samples,)))
+            else:
+                return None
+        return self.arrays[key]
+
+    def __call__(self, model, point, compute):
+        # output of compute() for the current batch, read from the cache when all of its samples were stored
+        if self.indices is None or (self.points is not None and point not in self.points):
+            return compute()
+        indices = np.asarray(self.indices)
+        config = self.upstream_config(model, point)
+        arrays = self.open(point, config) if config is not None else None
+        if arrays is not None and arrays[1][indices].all():
+            self.hits += 1
+            for recorded in self.recording: # the enclosing points depend on this point's upstream modules
+                recorded.update(self.upstream[point])
+            device = next(model.parameters()).device
+            return torch.from_numpy(arrays[0][indices]).to(device)
+
+        # compute the point, recording the modules it evaluates
+        self.misses += 1
+        recorded = set()
+        self.recording.append(recorded)
+        def record(name):
+            def hook(module, input, output):
+                recorded.add(name)
+            return hook
+        handles = [m.register_forward_hook(record(name)) for name, m in model.named_modules() if name != '']
+        try:
+            output = compute()
+        finally:
+            for handle in handles:
+                handle.remove()
+            self.recording.pop()
+        for enclosing in self.recording:
+            enclosing.update(recorded)
+
+        if sorted(recorded) != self.upstream_modules(point):
+            self.upstream[point] = sorted(recorded)
+            with open(os.path.join(self.cache_dir, point + '.modules.json'), 'w') as f:
+                json.dump(self.upstream[point], f)
+        outputs, valid = self.open(point, self.upstream_config(model, point), output)
+        outputs[indices] = output.detach().cpu().numpy()
+        outputs.flush()
+        valid[indices] = 1  # after the outputs: an interrupted write leaves the rows invalid
+        valid.flush()
+        return output
+
+def cached(model, point, compute):
+    # Model forwards call cached() at their cache points: compute() unless the model has a layer_cache
+    layer_cache = getattr(model, 'layer_cache', None)
+    if layer_cache is None:
+        return compute()
+    return layer_cache(model, point, compute)
+
+def batch_indices(loader, batch_idx, n):
+    # Dataset indices of mini-batch batch_idx (n samples) of an unshuffled loader
+    start = batch_idx * loader.batch_size
+    if isinstance(loader.dataset, torch.utils.data.Subset):
+        return list(loader.dataset.indices[start:start + n])
+    return list(range(start, start + n))
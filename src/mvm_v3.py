@@ -8,6 +8,8 @@ import time
 import os
 import argparse
 import pdb
+import warnings
+from collections import OrderedDict
 
 import src.config as cfg
 
@@ -83,89 +85,788 @@ def bit_slicing(weight, frac_bit, bit_slice, weight_bits):  # version 2
     bitslice = bitslice.t()
     return bitslice
 
-def float_to_16bits_tensor_fast(input, frac_bits, bit_slice, bit_slice_num, input_bits): # input is batch x n tensor / output is n x 16 tensor..
+## Integer fixed-point engine (cfg.int_engine): the same fixed-point arithmetic as the float path with
+## bit-slices and bit-planes held in int8, and ADC codes, shift-add and accumulators in int64.
+
+def use_int_engine(input_bits):
+    # ideal crossbars with quantized inputs only: GENIEx outputs and unquantized (input_bits = 1) inputs are analog
+    return cfg.int_engine == True and cfg.non_ideality == False and input_bits != 1
+
+def float_to_fixed_int(input, frac_bits, bits):
+    # float --> two's complement fixed point integer, saturated as in float_to_16bits_tensor_fast
+    int_bit = bits - frac_bits - 1
+    input = torch.clamp(input, -2**int_bit, 2**int_bit-1/2**frac_bits)
+    return torch.floor(input.mul(2**frac_bits)).long()
+
+def fixed_int_to_planes(input_int, bit_slice, bit_slice_num):
+    # [..., n] fixed point integers --> [..., n, bit_slice_num] digits of bit_slice bits, MSB----->LSB
+    # (arithmetic shift: negative numbers give their two's complement digits)
+    shifts = torch.arange(bit_slice_num-1, -1, -1, device=input_int.device).mul(bit_slice)
+    digits = (input_int.unsqueeze(-1) >> shifts) & (2**bit_slice-1)
+    return digits.to(torch.int8 if bit_slice < 8 else torch.int16)
+
+def bit_slicing_int(weight, frac_bit, bit_slice, weight_bits):
+    # integer version of bit_slicing: [out_channel, length] --> [length, out_channel*bit_slice_num], MSB slice first
+    bit_slice_num = weight_bits//bit_slice
+    weight_slices = fixed_int_to_planes(float_to_fixed_int(weight, frac_bit, weight_bits), bit_slice, bit_slice_num)
+    return weight_slices.permute(1,0,2).reshape(weight.shape[1], -1)
+
+def float_to_16bits_tensor_fast(input, frac_bits, bit_slice, bit_slice_num, input_bits, out=None): # input is batch x n tensor / output is batch x n x 16 tensor
+    # Converts once to two's complement fixed point and extracts all bit-planes with one shift-and-mask, MSB----->LSB.
+    # out: preallocated batch x N x bit_slice_num buffer (N >= n, zero padded); the planes are written to out[:, :n]
 
     if(input_bits==1): # (NOTE) assuming inputs are binary
-        return input.unsqueeze(-1)
+        input_sliced = input.unsqueeze(-1)
+    else:
+        input_sliced = fixed_int_to_planes(float_to_fixed_int(input, frac_bits, input_bits), bit_slice, bit_slice_num)
+
+    if out is None:
+        return input_sliced.to(input.dtype)
+    out[:,:input.shape[1]] = input_sliced
+    return out
+
+## Crossbar programming: W+/W- split --> fixed point --> bit slice --> xbars
+## The programmed state only depends on the weight and the bit-width config,
+## so layers keep it in a per-layer cache and only re-program when either changes.
+
+def program_xbars(weight, bit_slice, weight_bits, weight_bit_frac, bit_slicer=bit_slicing):
+    # Shared by Conv2d_mvm and Linear_mvm: weight is [out_channels, in_channels(, kernel_row, kernel_col)]
+    device = weight.device
+    weight_channels_out = weight.shape[0]
+    weight_temp = weight.reshape((weight_channels_out, -1))     ## flatten weights
+    pos_weight = torch.clamp(weight_temp, min=0)                ## W+ / W-
+    neg_weight = torch.clamp(weight_temp, max=0).abs()
+    pos_bit_slice_weight = bit_slicer(pos_weight, weight_bit_frac, bit_slice, weight_bits).to(device) ## v2: flatten weights --> fixed point --> bit slice -- v1
+    neg_bit_slice_weight = bit_slicer(neg_weight, weight_bit_frac, bit_slice, weight_bits).to(device)
+
+    # bitsliced weight into 128x128 xbars
+    # xbar_row separates inputs --> results in a same column with different rows will be added later
+    xbar_row = math.ceil(pos_bit_slice_weight.shape[0]/cfg.xbar_row_size)
+    xbar_col = math.ceil(pos_bit_slice_weight.shape[1]/cfg.xbar_col_size)
+
+    weight_xbar = torch.zeros((2,xbar_row*cfg.xbar_row_size, xbar_col*cfg.xbar_col_size), dtype=pos_bit_slice_weight.dtype).to(device)
+    weight_xbar[0,:pos_bit_slice_weight.shape[0], :pos_bit_slice_weight.shape[1]] = pos_bit_slice_weight
+    weight_xbar[1,:neg_bit_slice_weight.shape[0], :neg_bit_slice_weight.shape[1]] = neg_bit_slice_weight
+
+    # xbars shape: [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE] - a view of weight_xbar, no copy
+    xbars = weight_xbar.unfold(1,cfg.xbar_row_size, cfg.xbar_row_size).unfold(2, cfg.xbar_col_size, cfg.xbar_col_size)
+    return xbars
+
+def program_conductance(xbars, bit_slice):
+    # bit-sliced levels --> conductances for the GENIEx model
+    # G_real shape:         [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+    # G_real_flatten shape: [2, xbars_row, xbars_col, XBAR_ROW_SIZE*XBAR_COL_SIZE] (column major within a xbar)
+    Gon = cfg.Gon
+    Goff = cfg.Goff
+    Nstates_slice = 2**bit_slice-1
+    G_real = (xbars*(Gon - Goff)/Nstates_slice + Goff)
+    G_real_scaled = (G_real-Goff)/(Gon-Goff)
+    G_real_flatten = G_real_scaled.permute(0,1,2,4,3).reshape(2, xbars.shape[1], xbars.shape[2], cfg.xbar_row_size*cfg.xbar_col_size)
+    return G_real, G_real_flatten
+
+def program_xbars_sparse(weight, bit_slice, weight_bits, weight_bit_frac):
+    # Block-sparse storage of programmed xbars (cfg.sparse_xbar_storage): the occupied crossbars only, as CSR matrices of
+    # their non-zero cells over the layer inputs, so memory and compute scale with the non-zero cells. Programmed from the
+    # non-zero weights alone: the dense xbars are never materialized, only the cells (and the dense weight itself).
+    # 'shape':    shape of the dense xbars [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+    # 'index':    (W+/W-, xbar row, xbar col) of each occupied crossbar, as xbar_index
+    # 'cells':    [num_occupied*XBAR_COL_SIZE, xbars_row*XBAR_ROW_SIZE] bit-slice digits (bit-serial path with ADC clipping)
+    # 'weights':  [num_occupied*XBAR_COL_SIZE/bit_slice_num, xbars_row*XBAR_ROW_SIZE] float64 fixed point weights of the
+    #             output columns, the bit-slices combined (closed-form path)
+    # 'adc_reduction': as adc_reduction() of the dense xbars
+    device = weight.device
+    bit_slice_num = weight_bits//bit_slice
+    xbar_row_size = cfg.xbar_row_size
+    xbar_col_size = cfg.xbar_col_size
+    weight_temp = weight.reshape((weight.shape[0], -1))
+    xbars_row = math.ceil(weight_temp.shape[1]/xbar_row_size)
+    xbars_col = math.ceil(weight_temp.shape[0]*bit_slice_num/xbar_col_size)
+    shape = (2, xbars_row, xbars_col, xbar_row_size, xbar_col_size)
+
+    # bit-slices of the non-zero weights, by the same (elementwise) slicer as program_xbars: [nnz, bit_slice_num] MSB first
+    out_index, in_index = weight_temp.nonzero(as_tuple=True)
+    values = weight_temp[out_index, in_index]
+    digits = bit_slicing(values.abs().reshape(1, -1), weight_bit_frac, bit_slice, weight_bits).to(device).reshape(-1, bit_slice_num)
+    n, s = digits.nonzero(as_tuple=True)
+    cell_values = digits[n, s]
+    w = values[n].lt(0).long()                          # W- holds the negative weights
+    cols = in_index[n]                                  # layer input = xbar row * XBAR_ROW_SIZE + row in the xbar
+    x = cols // xbar_row_size
+    out_col = out_index[n]*bit_slice_num + s            # bit-sliced output column = xbar col * XBAR_COL_SIZE + column in the xbar
+    y = out_col // xbar_col_size
+    c = out_col.remainder(xbar_col_size)
+
+    # occupied crossbars in the order of occupied.nonzero() of the dense xbars
+    occupied, k = torch.unique((w*xbars_row + x)*xbars_col + y, sorted=True, return_inverse=True)
+    index = (occupied // (xbars_row*xbars_col), (occupied // xbars_col).remainder(xbars_row), occupied.remainder(xbars_col))
+    num_occupied = occupied.shape[0]
+
+    # (NOTE) torch sparse CSR is in beta and warns on construction
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='.*[Ss]parse')
+        cells = torch.sparse_coo_tensor(torch.stack([k*xbar_col_size + c, cols]), cell_values.float(),
+                                        (num_occupied*xbar_col_size, xbars_row*xbar_row_size)).coalesce().to_sparse_csr()
+        slice_weight = torch.pow(2.0, bit_slice*(bit_slice_num-1 - s)).double()   # MSB --> LSB
+        weights = torch.sparse_coo_tensor(torch.stack([k*(xbar_col_size//bit_slice_num) + c // bit_slice_num, cols]),
+                                          cell_values.double()*slice_weight,
+                                          (num_occupied*(xbar_col_size//bit_slice_num), xbars_row*xbar_row_size)).coalesce().to_sparse_csr()
+
+    # non-zero weights per (xbar row, xbar col, output column) for the per-column ADC resolution
+    nonzero = digits.ne(0).any(1)
+    out_col = out_index[nonzero]*bit_slice_num
+    column = (in_index[nonzero] // xbar_row_size * xbars_col + out_col // xbar_col_size)*(xbar_col_size//bit_slice_num) \
+             + out_col.remainder(xbar_col_size) // bit_slice_num
+    nonzero_count = torch.bincount(column, minlength=xbars_row*xbars_col*(xbar_col_size//bit_slice_num))
+    sparsity = 1 - nonzero_count.reshape(xbars_row, xbars_col, -1).float() / xbar_row_size
+    return {'shape': shape, 'index': index, 'cells': cells, 'weights': weights,
+            'adc_reduction': adc_reduction_buckets(sparsity, bit_slice_num)}
+
+def get_programmed_xbars(xbar_cache, weight, bit_slice, weight_bits, weight_bit_frac, xbmodel=None):
+    # Returns the programmed crossbar state of a layer: {'xbars', 'xbars_shape', 'G_real', 'G_real_flatten', 'G_proj', 'niratio_memo',
+    # 'xbars_int', 'xbar_occupied', 'xbar_index', 'xbars_occupied', 'adc_reduction', 'xbars_sparse'}
+    # xbar_cache is owned by the layer and holds one entry per device. An entry is reused as long as it was
+    # built from the same weight tensor, at the same version counter (bumped by every in-place update such as
+    # optimizer.step() or pruning), and with the same bit-width / crossbar configuration.
+    # (NOTE) writes through weight.data bypass the version counter - clear the cache after those.
+    key = (weight.data_ptr(), weight._version, tuple(weight.shape), bit_slice, weight_bits, weight_bit_frac,
+           cfg.xbar_row_size, cfg.xbar_col_size, cfg.non_ideality, cfg.Gon, cfg.Goff, cfg.int_engine, cfg.sparse_xbars, cfg.adc_per_column,
+           cfg.sparse_xbar_storage, cfg.batch_bit_stream)
+    if cfg.non_ideality == True and xbmodel is not None: # GENIEx model identity and parameter versions (load_state_dict, training)
+        key += (cfg.geniex_memo_size > 0, id(xbmodel),) + tuple((p.data_ptr(), p._version) for p in xbmodel.parameters())
+    if xbar_cache is not None:
+        state = xbar_cache.get(weight.device)
+        if state is not None and state['weight'] is weight and state['key'] == key:
+            return state
+
+    # block-sparse storage of the ideal float engine (cfg.sparse_xbar_storage), programmed without the dense xbars. Its
+    # bit-serial form is the batched one, so the loop path (batch_bit_stream = False) keeps dense xbars (same results),
+    # as do PyTorch versions without sparse CSR tensors.
+    sparse_storage = cfg.sparse_xbar_storage and cfg.batch_bit_stream and cfg.non_ideality == False and cfg.int_engine == False \
+                     and hasattr(torch.Tensor, 'to_sparse_csr')
+    with torch.no_grad():
+        if sparse_storage:
+            xbars_sparse = program_xbars_sparse(weight.detach(), bit_slice, weight_bits, weight_bit_frac)
+            state = {'weight': weight, 'key': key, 'xbars': None, 'xbars_shape': xbars_sparse['shape'], 'xbars_sparse': xbars_sparse,
+                     'xbar_occupied': None, 'xbar_index': None, 'xbars_occupied': None,
+                     'adc_reduction': xbars_sparse['adc_reduction'] if cfg.adc_per_column else None}
+        else:
+            xbars = program_xbars(weight.detach(), bit_slice, weight_bits, weight_bit_frac)
+            state = {'weight': weight, 'key': key, 'xbars': xbars, 'xbars_shape': tuple(xbars.shape), 'xbars_sparse': None}
+            if cfg.non_ideality == True:
+                state['G_real'], state['G_real_flatten'] = program_conductance(xbars, bit_slice)
+                # conductance half of the GENIEx first layer, shared by every input of a crossbar
+                state['G_proj'] = xbmodel.project_conductance(state['G_real_flatten']) if hasattr(xbmodel, 'forward_split') else None
+                # GENIEx ratios of the crossbar inputs seen so far (dropped with the programmed xbars)
+                state['niratio_memo'] = {'entries': OrderedDict(), 'hits': 0, 'misses': 0} if cfg.geniex_memo_size > 0 else None
+            if cfg.int_engine == True:
+                state['xbars_int'] = program_xbars(weight.detach(), bit_slice, weight_bits, weight_bit_frac, bit_slicing_int)
+            # occupancy index of sparse layers (pruning, padded edge xbars, deep bit-slices of small weights): only the
+            # non-zero crossbars are evaluated, gathered in xbars_occupied [num_occupied, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+            state['xbar_occupied'] = state['xbar_index'] = state['xbars_occupied'] = None
+            occupied = xbars.reshape(2, xbars.shape[1], xbars.shape[2], -1).ne(0).any(3)   # [2, xbars_row, xbars_col]
+            if cfg.sparse_xbars > 0 and occupied.float().mean().item() <= cfg.sparse_xbars:
+                state['xbar_occupied'] = occupied
+                state['xbar_index'] = occupied.nonzero(as_tuple=True)   # (W+/W-, xbar row, xbar col) of each occupied crossbar
+                state['xbars_occupied'] = xbars[state['xbar_index']]
+            # per-column ADC resolution (cfg.adc_per_column): bits of ADC reduction of every crossbar column
+            state['adc_reduction'] = adc_reduction(xbars, weight_bits//bit_slice) if cfg.adc_per_column else None
+
+    if xbar_cache is not None:
+        xbar_cache[weight.device] = state
+    return state
+
+def adc_reduction(xbars, bit_slice_num):
+    # Bits of ADC reduction of every crossbar column [xbars_row, xbars_col, XBAR_COL_SIZE], from the sparsity of the weight
+    # column it holds a bit-slice of, in the buckets of adc_stats (pruning/sparsity.py): < 50% zeros: 0, < 75%: -1,
+    # < 88%: -2, < 94%: -3, < 97%: -4, else -5. A zero weight is zero in all its bit-slices of W+ and W-, padded rows
+    # count as zeros (as in sparsity_metrics).
+    xbars_row = xbars.shape[1]
+    xbars_col = xbars.shape[2]
+    nonzero = xbars.reshape(2, xbars_row, xbars_col, xbars.shape[3], -1, bit_slice_num).ne(0).any(5).any(0)   # [xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE/bit_slice_num]
+    sparsity = torch.sum(~nonzero, 2).float() / xbars.shape[3]
+    return adc_reduction_buckets(sparsity, bit_slice_num)
+
+def adc_reduction_buckets(sparsity, bit_slice_num):
+    # [xbars_row, xbars_col, XBAR_COL_SIZE/bit_slice_num] weight column sparsity --> bits of ADC reduction per crossbar column
+    reduction = sum((sparsity >= 1-1/2.0**i).long() for i in range(1, 6))
+    return reduction.repeat_interleave(bit_slice_num, dim=2)
+
+def adc_max_code(adc_bit, adc_reduction, stream_dim=False):
+    # Largest ADC code: 2**adc_bit-1, or per crossbar column with an adc_reduction (at least 1 bit), as a
+    # [xbars_row, xbars_col(, 1), XBAR_COL_SIZE] tensor broadcast against the crossbar outputs (stream_dim: with a bit-stream dimension)
+    if adc_reduction is None:
+        return 2**adc_bit-1
+    adc_max = torch.pow(2, torch.clamp(adc_bit - adc_reduction, min=1)) - 1
+    return adc_max.unsqueeze(2) if stream_dim else adc_max
+
+def adc_clamp(output_analog, adc_max):
+    # ADC range [0, adc_max] (adc_max_code)
+    if torch.is_tensor(adc_max):
+        return torch.min(torch.clamp(output_analog, min=0), adc_max.to(output_analog.dtype))
+    return torch.clamp(output_analog, min=0, max=adc_max)
+
+def adc_min_bit(adc_bit, adc_reduction):
+    # Resolution of the lowest-resolution ADC of a layer
+    if adc_reduction is None:
+        return adc_bit
+    return max(1, adc_bit - int(adc_reduction.max()))
+
+def get_workspace(workspace, name, shape, device, dtype=torch.float):
+    # Scratch tensor of a layer, reused across forwards (and conv chunks) with the same name, shape, device and dtype.
+    # workspace is owned by the layer. New buffers are zero filled, reused ones keep their contents: callers overwrite
+    # what they read, and regions they never write (e.g. padding) stay zero. Never return a workspace buffer.
+    if workspace is None:
+        return torch.zeros(shape, dtype=dtype, device=device)
+    key = (name, tuple(shape), device, dtype)
+    buffer = workspace.get(key)
+    if buffer is None:
+        buffer = torch.zeros(shape, dtype=dtype, device=device)
+        workspace[key] = buffer
+    return buffer
+
+def adc_never_clips(xbar_row_size, bit_slice, bit_stream, adc_bit, input_bits):
+    # Largest column output of one xbar for one input bit-stream: every row driven with the largest
+    # input digit through the largest conductance level. If that fits in the ADC, the clamp is a no-op.
+    if input_bits == 1: # (NOTE) binary inputs are not quantized, so they are not bounded by the digit range
+        return False
+    max_analog = xbar_row_size * (2**bit_stream-1) * (2**bit_slice-1)
+    return max_analog <= 2**adc_bit-1
+
+def micro_batch_row_bytes(xbars_row, xbars_col, bit_slice, bit_stream, bit_stream_num, bit_slice_num, input_bits, adc_bit):
+    # Estimated peak scratch memory (bytes) per (batch x output pixel) row of a layer forward, for the mvm path the
+    # layer takes: the bit-plane inputs and signs (with their float64 / gathered copies), output_reg, and the crossbar
+    # outputs alive at once. Measured on CPU, the estimate is within ~20% of the peak.
+    signs = 2 if bit_stream > 1 else 1
+    inputs = (1+2*signs)*2*xbars_row*XBAR_ROW_SIZE*bit_stream_num*4
+    output_reg = signs*2*xbars_row*xbars_col*bit_stream_num*(XBAR_COL_SIZE//bit_slice_num)*4
+    if cfg.non_ideality == True:   # V_real, output_real, the GENIEx ratios and their products, for all bit-streams
+        analog = 6*signs*2*xbars_row*xbars_col*bit_stream_num*XBAR_COL_SIZE*4
+    elif input_bits != 1 and (bit_stream != 1 or adc_never_clips(XBAR_ROW_SIZE, bit_slice, bit_stream, adc_bit, input_bits)):
+        analog = 2*signs*2*xbars_row*xbars_col*(XBAR_COL_SIZE//bit_slice_num)*8   # mvm_tensor_gemm: float64 column outputs
+    elif cfg.batch_bit_stream or use_int_engine(input_bits):   # int64 ADC codes in the integer engine,
+        # a reordered copy of the crossbar outputs with block-sparse xbars
+        analog = (5 if use_int_engine(input_bits) else 3 if cfg.sparse_xbar_storage else 2)*2*xbars_row*xbars_col*bit_stream_num*XBAR_COL_SIZE*4
+    else:   # one bit-stream at a time
+        analog = 3*2*xbars_row*xbars_col*XBAR_COL_SIZE*4
+    return inputs + output_reg + analog
+
+def micro_batch_rows(num_rows, default_rows, xbars_row, xbars_col, bit_slice, bit_stream, bit_stream_num, bit_slice_num, input_bits, adc_bit):
+    # Rows per micro-batch of a layer forward. With cfg.memory_budget > 0 (bytes), the largest micro-batch whose
+    # estimated scratch memory fits in the budget (at least 1 row), otherwise default_rows (<= 0: all rows).
+    # Rows are independent MVMs, so the micro-batch size does not change the results.
+    if cfg.memory_budget > 0:
+        default_rows = max(1, cfg.memory_budget//micro_batch_row_bytes(xbars_row, xbars_col, bit_slice, bit_stream, bit_stream_num, bit_slice_num,
+                                                                               input_bits, adc_bit))
+    return min(default_rows, num_rows) if default_rows > 0 else num_rows
+
+def fixed_point_acc_int(output, weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac):
+    # accumulator of the float path (div_(2**shift).trunc_(), fmod_(2**acm_bit)) on int64
+    shift = input_bit_frac + weight_bit_frac - acm_bit_frac
+    if shift >= 0:  # truncating division by 2**shift: shift of the magnitude
+        sign = output.sign()
+        output = (output.abs() >> shift).mul_(sign)
+    else:
+        output.mul_(2**(-shift))
+    return output.fmod_(2**acm_bit)
+
+def mvm_tensor_int(input_int, input_sign, xbars_int, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac,
+                   adc_bit, acm_bit, acm_bit_frac, adc_reduction=None):
+    # Integer engine of mvm_tensor (cfg.int_engine) - bit-exact with the float path. Without ADC clipping it uses the
+    # closed form of mvm_tensor_gemm, otherwise the bit-serial form of mvm_tensor_batched with int64 ADC codes.
+
+    # input_int shape:  [batch_size, xbars_row, XBAR_ROW_SIZE] fixed point inputs (magnitudes for bit_stream > 1)
+    # input_sign shape: [batch_size, xbars_row, XBAR_ROW_SIZE] 1 for positive inputs (bit_stream > 1)
+    # xbars_int shape:  [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE] integer bit-slices (W+ / W-)
+    device = input_int.device
+    xbars_row = xbars_int.shape[1]
+    xbars_col = xbars_int.shape[2]
+    batch_size = input_int.shape[0]
+    bit_slice_num = weight_bits//bit_slice
+    bit_stream_num = input_bits//bit_stream
+    slice_shift = torch.arange(bit_slice_num-1, -1, -1, device=device).mul(bit_slice)      # MSB --> LSB
+
+    if bit_stream != 1 or adc_never_clips(xbars_int.shape[3], bit_slice, bit_stream, adc_min_bit(adc_bit, adc_reduction), input_bits):
+        # fixed point weight per output column: [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE/bit_slice_num]
+        weight_int = (xbars_int.long().reshape(2, xbars_row, xbars_col, xbars_int.shape[3], -1, bit_slice_num) << slice_shift).sum(5)
+        max_product = xbars_int.shape[3] * int(input_int.abs().max()) * int(weight_int.max())
+        assert max_product < 2**63, "Fixed point products overflow int64, disable cfg.int_engine"
+
+        if bit_stream == 1: # two's complement digits with a negative MSB add up to the signed input
+            output = torch.einsum('bxr,wxyrc->wbxyc', input_int, weight_int)
+            output = fixed_point_acc_int(output, weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac)
+
+            # + sum xbar_rows
+            output = torch.sum(output, 2).reshape(2, batch_size, -1).double().div_(2**acm_bit_frac).float()
+        else:
+            input_pos = torch.where(input_sign == 1, input_int, torch.zeros_like(input_int))
+            input_split = torch.stack([input_pos, input_int.sub(input_pos)])
+            output_split = torch.einsum('sbxr,wxyrc->wsbxyc', input_split, weight_int)
+            output_split = fixed_point_acc_int(output_split, weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac)
+
+            # + sum xbar_rows
+            output_split = torch.sum(output_split, 3).reshape(2, 2, batch_size, -1)
+            output = output_split[:,0].sub(output_split[:,1]).double().div_(2**acm_bit_frac).float()
+    else:
+        stream_weight = torch.tensor([2**(bit_stream*i) for i in range(bit_stream_num-1, -1, -1)], device=device)   # MSB --> LSB
+        stream_weight[0] *= -1      # MSB of a two's complement input --> subtract
+
+        input_planes = fixed_int_to_planes(input_int, bit_stream, bit_stream_num)   # [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+        # column sums of digits are small integers (< 2**24), so the xbar contraction itself runs on the float GEMM
+        output_analog = torch.einsum('bxrn,wxyrc->wbxync', input_planes.float(), xbars_int.float()).long()
+        output_analog = adc_clamp(output_analog, adc_max_code(adc_bit, adc_reduction, stream_dim=True))
+        # [2, batch_size, xbars_row, xbars_col, bit_stream_num, XBAR_COL_SIZE/bit_slice_num]
+        output_reg = (output_analog.reshape(2, batch_size, xbars_row, xbars_col, bit_stream_num, -1, bit_slice_num) << slice_shift).sum(6)
+
+        output = torch.einsum('wbxynk,n->wbxyk', output_reg, stream_weight)
+        output = fixed_point_acc_int(output, weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac)
+
+        # + sum xbar_rows
+        output = torch.sum(output, 2).reshape(2, batch_size, -1).double().div_(2**acm_bit_frac).float()
+
+    # W+ - W-
+    return output[0].sub(output[1])
+
+def xbars_scatter(output, xbar_index, xbars_col):
+    # Sums the per-crossbar outputs of the occupied crossbars over xbars_row. The crossbars left out are all-zero and
+    # add 0 (also after the fixed-point truncation), the float64 fixed-point sums are exact in any order.
+    # output shape:   [num_occupied, ..., XBAR_COL_SIZE/bit_slice_num]
+    # returns:        [2, ..., xbars_col*XBAR_COL_SIZE/bit_slice_num] (W+ / W-), as the dense sum over xbars_row
+    w_idx, _, y_idx = xbar_index
+    output_sum = output.new_zeros((2*xbars_col,) + output.shape[1:])
+    output_sum.index_add_(0, w_idx*xbars_col + y_idx, output)
+    output_sum = output_sum.reshape((2, xbars_col) + output.shape[1:])
+    output_sum = output_sum.permute(0, *range(2, output_sum.dim()-1), 1, output_sum.dim()-1)   # xbars_col next to the columns
+    return output_sum.reshape(2, *output.shape[1:-1], -1)
+
+def mvm_tensor_gemm(zeros, shift_add_bit_stream, shift_add_bit_slice, flatten_input, flatten_input_sign, xbars, bit_stream,
+                    weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac, xbar_index=None, xbars_occupied=None):
+    # Closed form of the bit-serial loop in mvm_tensor when the ADC never clips: shift-and-add is linear, so
+    # combining the input bit-streams and the weight bit-slices first gives one integer matmul per xbar_row.
+    # Computed in float64, where the fixed-point products and partial sums are exact.
+
+    # xbars shape:          [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE] (W+ / W-)
+    # flatten_input shape:  [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+    xbars_row = xbars.shape[1]
+    xbars_col = xbars.shape[2]
+    batch_size = flatten_input.shape[0]
+    stream_weight = shift_add_bit_stream[:, 0].double()   # LSB --> MSB
+    slice_weight = shift_add_bit_slice.double()             # MSB --> LSB
+    bit_slice_num = slice_weight.shape[0]
+
+    if xbar_index is not None:
+        return mvm_tensor_gemm_occupied(zeros, stream_weight, slice_weight, flatten_input, flatten_input_sign, xbars_col,
+                                        bit_stream, weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac, xbar_index, xbars_occupied)
+
+    # fixed point weight per output column: [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE/bit_slice_num]
+    weight_int = torch.matmul(xbars.double().reshape(2, xbars_row, xbars_col, xbars.shape[3], -1, bit_slice_num), slice_weight)
+
+    if bit_stream == 1:
+        input_int = torch.matmul(flatten_input.flip(-1).double(), stream_weight)    # [batch_size, xbars_row, XBAR_ROW_SIZE]
+        output = torch.einsum('bxr,wxyrc->wbxyc', input_int, weight_int)
+        output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+
+        # + sum xbar_rows
+        output = torch.sum(output, 2).reshape(2, batch_size, -1).float()
+    else:
+        input_pos = torch.where(flatten_input_sign == 1, flatten_input, zeros)
+        input_neg = flatten_input.sub(input_pos)
+        input_split = torch.stack([input_pos, input_neg])
+        input_int = torch.matmul(input_split.flip(-1).double(), stream_weight)      # [2, batch_size, xbars_row, XBAR_ROW_SIZE]
+        output_split = torch.einsum('sbxr,wxyrc->wsbxyc', input_int, weight_int)
+        output_split.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output_split.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+
+        # + sum xbar_rows
+        output_split = torch.sum(output_split, 3).reshape(2, 2, batch_size, -1)
+        output = output_split[:,0].sub(output_split[:,1]).float()
+
+    # W+ - W-
+    return output[0].sub(output[1])
+
+def mvm_tensor_gemm_occupied(zeros, stream_weight, slice_weight, flatten_input, flatten_input_sign, xbars_col, bit_stream,
+                             weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac, xbar_index, xbars_occupied):
+    # mvm_tensor_gemm over the occupied crossbars only (cfg.sparse_xbars): each occupied crossbar gets the inputs
+    # of its xbar_row, one matmul per crossbar, and the outputs are scattered back to the columns.
+    # xbars_occupied shape: [num_occupied, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+    _, x_idx, _ = xbar_index
+    batch_size = flatten_input.shape[0]
+    bit_slice_num = slice_weight.shape[0]
+    weight_int = torch.matmul(xbars_occupied.double().reshape(xbars_occupied.shape[0], xbars_occupied.shape[1], xbars_occupied.shape[2]//bit_slice_num, bit_slice_num), slice_weight)
+
+    if bit_stream == 1:
+        input_int = torch.matmul(flatten_input[:, x_idx].flip(-1).double(), stream_weight)    # [batch_size, num_occupied, XBAR_ROW_SIZE]
+        output = torch.einsum('bkr,krc->kbc', input_int, weight_int)
+        output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+        output = xbars_scatter(output, xbar_index, xbars_col).reshape(2, batch_size, -1).float()
     else:
+        input_pos = torch.where(flatten_input_sign == 1, flatten_input, zeros)
+        input_neg = flatten_input.sub(input_pos)
+        input_split = torch.stack([input_pos, input_neg])
+        input_int = torch.matmul(input_split[:, :, x_idx].flip(-1).double(), stream_weight)  # [2, batch_size, num_occupied, XBAR_ROW_SIZE]
+        output_split = torch.einsum('sbkr,krc->ksbc', input_int, weight_int)
+        output_split.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output_split.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+        output_split = xbars_scatter(output_split, xbar_index, xbars_col).reshape(2, 2, batch_size, -1)
+        output = output_split[:,0].sub(output_split[:,1]).float()
+
+    # W+ - W-
+    return output[0].sub(output[1])
 
-        int_bit = input_bits - frac_bits -1 # extra -1 for sign bit
-        #clamp data into the available range
-        input = torch.clamp(input, -2**int_bit, 2**int_bit-1/2**frac_bits)
-        #normalize
-        input = input.div_(2**int_bit)
-        #left shift all the fracional values so that all 16 bits comes to the left of decimal
-        input = input.mul_(2**(input_bits-1))
-        #take the integer part of the input, which represents our 16bit number
-        input = torch.floor(input)
-        #divide by scalar to get the decimal representation back, MSB----->LSB
-        input_sliced = torch.stack([torch.floor(torch.div(input, 2**(i*bit_slice))) - \
-                                    torch.mul(torch.floor(torch.div(input, 2**((i+1)*bit_slice))), 2**bit_slice) for i in range(bit_slice_num-1,-1,-1) ])
-        del input
-        return input_sliced.permute(1,2,0)
-
-def mvm_tensor(zeros, shift_add_bit_stream, shift_add_bit_slice, output_reg, flatten_input, flatten_input_sign, bias_addr, 
-               xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, acm_bit_frac): 
+def mvm_tensor_batched(shift_add_bit_stream, shift_add_bit_slice, flatten_input, xbars, adc_bit, weight_bit_frac, input_bit_frac,
+                       acm_bit, acm_bit_frac, xbar_index=None, xbars_occupied=None, adc_reduction=None):
+    # bit_stream = 1 loop of mvm_tensor with every input bit-stream evaluated at once along a bit-plane dimension:
+    # one crossbar contraction, one ADC clamp and one shift-add contraction per call (cfg.batch_bit_stream).
+    # The shift-add over bit-streams runs in float64, where the accumulator is exact.
+
+    # xbars shape:          [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE] (W+ / W-)
+    # flatten_input shape:  [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+    xbars_row = xbars.shape[1]
+    xbars_col = xbars.shape[2]
+    batch_size = flatten_input.shape[0]
+    bit_stream_num = flatten_input.shape[3]
+    stream_weight = shift_add_bit_stream[:, 0].flip(0).double()   # MSB --> LSB, as flatten_input
+    slice_weight = shift_add_bit_slice                              # MSB --> LSB
+    bit_slice_num = slice_weight.shape[0]
+
+    if cfg.skip_zero_inputs:
+        # all-zero bit-planes (e.g. the high-order planes after ReLU) give ADC codes of 0 and add nothing
+        live = flatten_input.reshape(-1, bit_stream_num).ne(0).any(0)
+        if not live.all():
+            flatten_input = flatten_input[:, :, :, live]
+            stream_weight = stream_weight[live]
+            bit_stream_num = flatten_input.shape[3]
+
+    if xbar_index is not None:
+        # occupied crossbars only (cfg.sparse_xbars): [num_occupied, batch_size, bit_stream_num, XBAR_COL_SIZE]
+        output_analog = torch.einsum('bkrn,krc->kbnc', flatten_input[:, xbar_index[1]], xbars_occupied)
+        adc_max = adc_max_code(adc_bit, adc_reduction)
+        if adc_reduction is not None:   # [num_occupied, 1, 1, XBAR_COL_SIZE]
+            adc_max = adc_max[xbar_index[1], xbar_index[2]].reshape(-1, 1, 1, xbars_occupied.shape[2])
+        output_analog = adc_clamp(output_analog, adc_max)
+        output_analog = output_analog.type(torch.float)
+        output_reg = torch.matmul(output_analog.reshape(output_analog.shape[0], batch_size, bit_stream_num, xbars_occupied.shape[2]//bit_slice_num, bit_slice_num), slice_weight)
+        output = torch.einsum('kbnq,n->kbq', output_reg.double(), stream_weight)
+        output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+        output = xbars_scatter(output, xbar_index, xbars_col).reshape(2, batch_size, -1).float()
+        return output[0].sub(output[1])
+
+    output_analog = torch.einsum('bxrn,wxyrc->wbxync', flatten_input, xbars)
+    output_analog = adc_clamp(output_analog, adc_max_code(adc_bit, adc_reduction, stream_dim=True))
+    output_analog = output_analog.type(torch.float)
+    # [2, batch_size, xbars_row, xbars_col, bit_stream_num, XBAR_COL_SIZE/bit_slice_num]
+    output_reg = torch.matmul(output_analog.reshape(2, batch_size, xbars_row, xbars_col, bit_stream_num, xbars.shape[4]//bit_slice_num, bit_slice_num), slice_weight)
+
+    output = torch.einsum('wbxynk,n->wbxyk', output_reg.double(), stream_weight)
+    output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+    output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+
+    # + sum xbar_rows, W+ - W-
+    output = torch.sum(output, 2).reshape(2, batch_size, -1).float()
+    return output[0].sub(output[1])
+
+def mvm_tensor_sparse(zeros, shift_add_bit_stream, shift_add_bit_slice, flatten_input, flatten_input_sign, xbars_sparse, bit_slice, bit_stream,
+                      weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, acm_bit_frac, adc_reduction=None):
+    # mvm_tensor on the block-sparse storage of the xbars (cfg.sparse_xbar_storage): one sparse x dense matmul of the occupied
+    # crossbars' cells with the layer inputs, in the closed form of mvm_tensor_gemm when the ADC never clips and in the
+    # batched bit-serial form of mvm_tensor_batched otherwise. Results are the same as the dense paths.
+
+    # flatten_input shape:  [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+    _, xbars_row, xbars_col, xbar_row_size, col_size = xbars_sparse['shape']
+    index = xbars_sparse['index']
+    num_occupied = index[0].shape[0]
+    batch_size = flatten_input.shape[0]
+    num_inputs = xbars_row*xbar_row_size
+    bit_stream_num = flatten_input.shape[3]
+    bit_slice_num = shift_add_bit_slice.shape[0]
+
+    if input_bits != 1 and (bit_stream != 1 or adc_never_clips(xbar_row_size, bit_slice, bit_stream, adc_min_bit(adc_bit, adc_reduction), input_bits)):
+        stream_weight = shift_add_bit_stream[:, 0].double()   # LSB --> MSB
+        if bit_stream == 1:
+            input_int = torch.matmul(flatten_input.flip(-1).double(), stream_weight)      # [batch_size, xbars_row, XBAR_ROW_SIZE]
+        else:
+            input_pos = torch.where(flatten_input_sign == 1, flatten_input, zeros)
+            input_neg = flatten_input.sub(input_pos)
+            input_int = torch.matmul(torch.stack([input_pos, input_neg]).flip(-1).double(), stream_weight)   # [2, batch_size, xbars_row, XBAR_ROW_SIZE]
+        # [num_occupied*XBAR_COL_SIZE/bit_slice_num, (2 x) batch_size]
+        output = torch.sparse.mm(xbars_sparse['weights'], input_int.reshape(-1, num_inputs).t())
+        output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+        output = xbars_scatter(output.reshape(num_occupied, col_size//bit_slice_num, output.shape[1]).transpose(1, 2), index, xbars_col)
+        if bit_stream == 1:
+            output = output.reshape(2, batch_size, -1).float()
+        else:
+            output = output.reshape(2, 2, batch_size, -1)
+            output = output[:,0].sub(output[:,1]).float()
+        # W+ - W-
+        return output[0].sub(output[1])
+
+    stream_weight = shift_add_bit_stream[:, 0].flip(0).double()   # MSB --> LSB, as flatten_input
+    if cfg.skip_zero_inputs:
+        # all-zero bit-planes give ADC codes of 0 and add nothing
+        live = flatten_input.reshape(-1, bit_stream_num).ne(0).any(0)
+        if not live.all():
+            flatten_input = flatten_input[:, :, :, live]
+            stream_weight = stream_weight[live]
+            bit_stream_num = flatten_input.shape[3]
+
+    # [num_occupied*XBAR_COL_SIZE, batch_size*bit_stream_num]
+    output_analog = torch.sparse.mm(xbars_sparse['cells'], flatten_input.reshape(batch_size, num_inputs, bit_stream_num).transpose(0, 1).reshape(num_inputs, -1))
+    adc_max = adc_max_code(adc_bit, adc_reduction)
+    if adc_reduction is not None:   # [num_occupied*XBAR_COL_SIZE, 1]
+        adc_max = adc_max[index[1], index[2]].reshape(-1, 1)
+    output_analog = adc_clamp(output_analog, adc_max)
+    # [num_occupied, batch_size, bit_stream_num, XBAR_COL_SIZE], as mvm_tensor_batched
+    output_analog = output_analog.reshape(num_occupied, col_size, batch_size, bit_stream_num).permute(0, 2, 3, 1).contiguous()
+    output_reg = torch.matmul(output_analog.reshape(num_occupied, batch_size, bit_stream_num, col_size//bit_slice_num, bit_slice_num), shift_add_bit_slice)
+    output = torch.einsum('kbnq,n->kbq', output_reg.double(), stream_weight)
+    output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+    output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+    output = xbars_scatter(output, index, xbars_col).reshape(2, batch_size, -1).float()
+    # W+ - W-
+    return output[0].sub(output[1])
+
+def mvm_tensor(zeros, shift_add_bit_stream, shift_add_bit_slice, output_reg, flatten_input, flatten_input_sign, bias_addr,
+               xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, acm_bit_frac,
+               xbar_index=None, xbars_occupied=None, adc_reduction=None, xbars_sparse=None):
 #def mvm_tensor(flatten_input, flatten_input_sign, bias_addr, xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, acm_bit_frac, device):   # version 2
- 
-    # xbars shape:          [xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+
+    # Evaluates the positive and negative arrays in one pass (leading dimension of xbars and output_reg) and returns W+ - W-
+    # xbars shape:          [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
     # flatten_input shape:  [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+    # shift_add_bit_stream: [16, 1] and shift_add_bit_slice: [bit_slice_num], broadcast against output_reg
+    # xbar_index, xbars_occupied: occupancy index and occupied crossbars of a sparse layer (get_programmed_xbars), used
+    # by the closed-form and batched paths to skip the all-zero crossbars; None evaluates every crossbar
+    # adc_reduction:        [xbars_row, xbars_col, XBAR_COL_SIZE] bits of ADC reduction per crossbar column (cfg.adc_per_column), None for adc_bit everywhere
+    # xbars_sparse:         block-sparse storage of the xbars (program_xbars_sparse), used instead of xbars (None with it)
     # 2-bit bit-slicing
-    xbars_row = xbars.shape[0]
+    if xbars_sparse is not None:
+        return mvm_tensor_sparse(zeros, shift_add_bit_stream, shift_add_bit_slice, flatten_input, flatten_input_sign, xbars_sparse, bit_slice,
+                                 bit_stream, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, acm_bit_frac, adc_reduction)
+    xbars_row = xbars.shape[1]
+    xbars_col = xbars.shape[2]
     batch_size = flatten_input.shape[0]
+    bit_slice_num = shift_add_bit_slice.shape[0]
     bit_stream_num = input_bits//bit_stream
 
+    # bit_stream > 1 does not model ADC clipping, bit_stream = 1 only clips when the xbar can exceed the ADC range
+    if input_bits != 1 and (bit_stream != 1 or adc_never_clips(xbars.shape[3], bit_slice, bit_stream, adc_min_bit(adc_bit, adc_reduction), input_bits)):
+        return mvm_tensor_gemm(zeros, shift_add_bit_stream, shift_add_bit_slice, flatten_input, flatten_input_sign, xbars, bit_stream,
+                               weight_bit_frac, input_bit_frac, acm_bit, acm_bit_frac, xbar_index, xbars_occupied)
+    if bit_stream == 1 and cfg.batch_bit_stream:
+        return mvm_tensor_batched(shift_add_bit_stream, shift_add_bit_slice, flatten_input, xbars, adc_bit, weight_bit_frac, input_bit_frac,
+                                  acm_bit, acm_bit_frac, xbar_index, xbars_occupied, adc_reduction)
+
     if bit_stream == 1:
+        adc_max = adc_max_code(adc_bit, adc_reduction)
         for i in range(bit_stream_num): # 16bit input
-            input_stream = flatten_input[:,:,:,-1-i].reshape((batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1))
+            input_stream = flatten_input[:,:,:,-1-i]
+            if cfg.skip_zero_inputs and not input_stream.any(): # zero input: ADC codes of 0
+                output_reg[:,:,:,:,i,:] = 0
+                continue
             #####
-            output_analog = torch.mul(xbars, input_stream)
-            output_analog = torch.sum(output_analog,3)
-            output_analog = torch.clamp(output_analog, min=0, max=2**adc_bit-1)
+            # batched matmul over xbars_row: [batch_size, xbars_row, XBAR_ROW_SIZE] x [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+            output_analog = torch.einsum('bxr,wxyrc->wbxyc', input_stream, xbars)
+            output_analog = adc_clamp(output_analog, adc_max)
             #####
             output_analog = output_analog.type(torch.float)
-            output_analog=output_analog.reshape(shift_add_bit_slice.shape)  # for 32-fixed
-            output_reg[:,:,:,i,:] = torch.sum(torch.mul(output_analog, shift_add_bit_slice), 4)
+            output_analog=output_analog.reshape(2, batch_size, xbars_row, xbars_col, -1, bit_slice_num)  # for 32-fixed
+            output_reg[:,:,:,:,i,:] = torch.sum(torch.mul(output_analog, shift_add_bit_slice), 5)
 
-        output = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 3)
+        output = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 4)
         output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
         output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
 
         # + sum xbar_rows
-        output = torch.sum(output, 1).reshape(batch_size, -1) 
+        output = torch.sum(output, 2).reshape(2, batch_size, -1)
     else:
         input_pos = torch.where(flatten_input_sign == 1, flatten_input, zeros)
         input_neg = flatten_input.sub(input_pos)
         input_split = torch.stack([input_pos, input_neg])
         
         for i in range(bit_stream_num): # 16bit input
-            input_stream = input_split[:,:,:,:,-1-i].reshape((2, batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1)) #input is arranged from MSB---->LSB
+            input_stream = input_split[:,:,:,:,-1-i] #input is arranged from MSB---->LSB
+            if cfg.skip_zero_inputs and not input_stream.any(): # zero input: ADC codes of 0
+                output_reg[:,:,:,:,:,i,:] = 0
+                continue
             #####
-            output_analog = torch.mul(xbars, input_stream)
-            output_analog = torch.sum(output_analog,4)      #sum it along the row dim
+            output_analog = torch.einsum('sbxr,wxyrc->wsbxyc', input_stream, xbars)      #sum it along the row dim
             ####
             output_analog = output_analog.type(torch.float)
-            output_analog=output_analog.reshape(shift_add_bit_slice.shape)
-            output_reg[:,:,:,:,i,:] = torch.sum(torch.mul(output_analog, shift_add_bit_slice), 5) # -1 # adding across bit sliced dimension
+            output_analog=output_analog.reshape(2, 2, batch_size, xbars_row, xbars_col, -1, bit_slice_num)
+            output_reg[:,:,:,:,:,i,:] = torch.sum(torch.mul(output_analog, shift_add_bit_slice), 6) # -1 # adding across bit sliced dimension
 
-        output_split = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 4)
+        output_split = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 5)
 
         output_split.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
         output_split.fmod_(2**acm_bit).div_(2**acm_bit_frac)
 
         # + sum xbar_rows
-        output_split = torch.sum(output_split, 2).reshape(2, batch_size, -1)
-        output = output_split[0].sub(output_split[1])
+        output_split = torch.sum(output_split, 3).reshape(2, 2, batch_size, -1)
+        output = output_split[:,0].sub(output_split[:,1])
 
+    # W+ - W-
     #del shift_add_bit_stream, shift_add_bit_slice, output_reg
-    return output
+    return output[0].sub(output[1])
+
+def xbmodel_niratio(model, G_proj, G_real_flatten, V_real_scaled, memo=None, xbar_occupied=None):
+    # GENIEx non-ideality ratios of every crossbar input in one batched evaluation, split in calls of at most
+    # cfg.geniex_chunk_size rows to bound the memory of the model activations
+    # G_proj shape:         [2, xbars_row, xbars_col, hidden] conductance half of fc1 (None: run the full model)
+    # G_real_flatten shape: [2, xbars_row, xbars_col, XBAR_ROW_SIZE*XBAR_COL_SIZE]
+    # V_real_scaled shape:  [num_inputs, xbars_row, XBAR_ROW_SIZE] (batch x bit-streams x input signs)
+    # xbar_occupied shape:  [2, xbars_row, xbars_col] non-zero crossbars (None: all), the others are not evaluated
+    # returns:              [2, xbars_row, xbars_col, num_inputs, XBAR_COL_SIZE]
+    if memo is not None:
+        return xbmodel_niratio_memo(model, G_proj, G_real_flatten, V_real_scaled, memo, xbar_occupied)
+    num_inputs = V_real_scaled.shape[0]
+    xbars_row = G_real_flatten.shape[1]
+    xbars_col = G_real_flatten.shape[2]
+    # a zero input drives no current (output_real = output_bias = 0), so its ADC code is 0 whatever the ratio:
+    # only the live (input, xbar row) pairs go through the model, the others get a ratio of 1
+    live = V_real_scaled.ne(0).any(2) if cfg.skip_zero_inputs else None   # [num_inputs, xbars_row]
+    if xbar_occupied is not None or (live is not None and not live.all()):
+        if live is None:
+            live = V_real_scaled.new_ones((num_inputs, xbars_row), dtype=torch.bool)
+        row_index, input_index = live.t().nonzero(as_tuple=True)  # grouped by xbar row
+        output_niratio = V_real_scaled.new_ones((2, xbars_row, xbars_col, num_inputs, cfg.xbar_col_size))
+        if input_index.shape[0] > 0:
+            output_live = xbmodel_niratio_rows(model, G_proj, G_real_flatten, row_index, V_real_scaled[input_index, row_index], xbar_occupied)
+            output_niratio[:, row_index, :, input_index] = output_live.transpose(0, 1)
+        return output_niratio
+    chunk = max(1, cfg.geniex_chunk_size//(2*xbars_row*xbars_col)) if cfg.geniex_chunk_size > 0 else num_inputs
+
+    output_niratio = None
+    for start in range(0, num_inputs, chunk):
+        V_chunk = V_real_scaled[start:start+chunk].transpose(0,1)     # [xbars_row, chunk, XBAR_ROW_SIZE]
+        if G_proj is None:
+            G_int = G_real_flatten.unsqueeze(3).expand(-1, -1, -1, V_chunk.shape[1], -1)
+            V_int = V_chunk.unsqueeze(1).expand(2, -1, xbars_col, -1, -1)
+            input_VG = torch.cat((G_int, V_int), 4) # concat along the input dim of XB so total inputs = r^2+r
+            output_chunk = model(input_VG.reshape(-1, input_VG.shape[4]))
+        else:
+            # fc1 = conductance half (precomputed per crossbar) + voltage half (shared by W+/W- and xbars_col)
+            output_chunk = model.forward_split(G_proj.unsqueeze(3), V_chunk.unsqueeze(1))   # [2, xbars_row, xbars_col, chunk, XBAR_COL_SIZE]
+        output_chunk = output_chunk.reshape(2, xbars_row, xbars_col, V_chunk.shape[1], -1)
+        if chunk >= num_inputs:
+            return output_chunk
+        if output_niratio is None: # filled in place: no per-chunk results kept between the model temporaries (heap fragmentation)
+            output_niratio = output_chunk.new_empty((2, xbars_row, xbars_col, num_inputs, output_chunk.shape[4]))
+        output_niratio[:, :, :, start:start+chunk] = output_chunk
+    return output_niratio
+
+def xbmodel_niratio_rows(model, G_proj, G_real_flatten, row_index, V_real_scaled, xbar_occupied=None):
+    # GENIEx non-ideality ratios of (xbar row, input) pairs: input i drives the crossbars of xbar row row_index[i].
+    # row_index is sorted, so each xbar row is a contiguous run of inputs evaluated against its (broadcast) conductances.
+    # xbar_occupied: [2, xbars_row, xbars_col] mask of the non-zero crossbars (None: all). Empty crossbars are not
+    # evaluated and get a ratio of 1: all their cells are at Goff, so output_real - output_bias = 0 and the ADC code is 0.
+    # V_real_scaled shape:  [num_inputs, XBAR_ROW_SIZE]
+    # returns:              [2, num_inputs, xbars_col, XBAR_COL_SIZE]
+    num_inputs = V_real_scaled.shape[0]
+    xbars_col = G_real_flatten.shape[2]
+    rows, counts = torch.unique_consecutive(row_index, return_counts=True)
+
+    output_niratio = V_real_scaled.new_ones((2, num_inputs, xbars_col, cfg.xbar_col_size))
+    end = 0
+    for xrow, count in zip(rows.tolist(), counts.tolist()):
+        end += count
+        occupied = xbar_occupied[:, xrow].reshape(-1) if xbar_occupied is not None else None   # [2*xbars_col]
+        if occupied is not None and occupied.all():
+            occupied = None
+        G_row = (G_real_flatten if G_proj is None else G_proj)[:, xrow].reshape(2*xbars_col, -1)
+        if occupied is not None:
+            G_row = G_row[occupied]
+        xbars_num = G_row.shape[0]
+        if xbars_num == 0:
+            continue
+        chunk = max(1, cfg.geniex_chunk_size//xbars_num) if cfg.geniex_chunk_size > 0 else count
+        for start in range(end-count, end, chunk):
+            V_chunk = V_real_scaled[start:min(start+chunk, end)]
+            if G_proj is None:
+                G_int = G_row.unsqueeze(1).expand(-1, V_chunk.shape[0], -1)
+                V_int = V_chunk.unsqueeze(0).expand(xbars_num, -1, -1)
+                input_VG = torch.cat((G_int, V_int), 2)
+                output_chunk = model(input_VG.reshape(-1, input_VG.shape[2]))
+            else:
+                output_chunk = model.forward_split(G_row.unsqueeze(1), V_chunk.unsqueeze(0))   # [xbars_num, chunk, XBAR_COL_SIZE]
+            output_chunk = output_chunk.reshape(xbars_num, V_chunk.shape[0], -1).to(output_niratio.dtype)
+            if occupied is None:
+                output_niratio[:, start:start+V_chunk.shape[0]] = output_chunk.reshape(2, xbars_col, V_chunk.shape[0], -1).transpose(1, 2)
+            else:
+                output_occupied = output_chunk.new_ones((2*xbars_col,) + output_chunk.shape[1:])
+                output_occupied[occupied] = output_chunk
+                output_niratio[:, start:start+V_chunk.shape[0]] = output_occupied.reshape(2, xbars_col, V_chunk.shape[0], -1).transpose(1, 2)
+    return output_niratio
+
+def xbmodel_niratio_memo(model, G_proj, G_real_flatten, V_real_scaled, memo, xbar_occupied=None):
+    # xbmodel_niratio with an LRU memo in front of the model. For a programmed layer the ratios of a crossbar row
+    # ([2, xbars_col, XBAR_COL_SIZE]) only depend on its input voltages, which take few distinct values (bit-streams
+    # of post-ReLU activations, zeros). Only inputs missing from the memo are evaluated, once per distinct vector.
+    # memo: {'entries': OrderedDict (xbar row, voltage bytes) -> ratios, 'hits': int, 'misses': int}
+    num_inputs = V_real_scaled.shape[0]
+    xbars_row = G_real_flatten.shape[1]
+    entries = memo['entries']
+
+    unique_inverse = []
+    unique_niratio = [] # per xbar row, the ratios of its distinct inputs (local: the memo may evict them in this call)
+    miss_rows = []
+    miss_V = []
+    miss_addr = []
+    for xrow in range(xbars_row):
+        V_unique, inverse = torch.unique(V_real_scaled[:, xrow], dim=0, return_inverse=True)
+        niratio = []
+        for u, v in enumerate(V_unique.cpu().numpy()):
+            key = (xrow, v.tobytes())
+            value = entries.get(key)
+            if value is None:
+                miss_rows.append(xrow)
+                miss_V.append(V_unique[u])
+                miss_addr.append((xrow, u, key))
+            else:
+                entries.move_to_end(key)
+            niratio.append(value)
+        unique_inverse.append(inverse)
+        unique_niratio.append(niratio)
+
+    if len(miss_V) > 0:
+        row_index = torch.tensor(miss_rows, device=V_real_scaled.device)
+        output_miss = xbmodel_niratio_rows(model, G_proj, G_real_flatten, row_index, torch.stack(miss_V), xbar_occupied)
+        for i, (xrow, u, key) in enumerate(miss_addr):
+            value = output_miss[:, i].clone()
+            unique_niratio[xrow][u] = value
+            entries[key] = value
+        while len(entries) > cfg.geniex_memo_size:
+            entries.popitem(last=False)
+    memo['misses'] += len(miss_V)
+    memo['hits'] += num_inputs*xbars_row - len(miss_V)
+
+    # [2, xbars_row, xbars_col, num_inputs, XBAR_COL_SIZE], as xbmodel_niratio
+    return torch.stack([torch.stack(unique_niratio[xrow], 1)[:, unique_inverse[xrow]] for xrow in range(xbars_row)], 1).transpose(2, 3)
+
+def niratio_memo_stats(xbar_cache):
+    # hits / misses / entries of the GENIEx ratio memo of a layer (summed over devices), e.g. niratio_memo_stats(layer.xbar_cache)
+    stats = {'hits': 0, 'misses': 0, 'entries': 0}
+    for state in xbar_cache.values():
+        memo = state.get('niratio_memo')
+        if memo is not None:
+            stats['hits'] += memo['hits']
+            stats['misses'] += memo['misses']
+            stats['entries'] += len(memo['entries'])
+    return stats
 
 def mvm_tensor_nonid(zeros, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten, G_real, model, flatten_input,
                    flatten_input_sign, bias_addr, xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bit, 
-                   acm_bit_frac):  #### These should be 'almost' completely changed. 
+                   acm_bit_frac, G_proj=None, niratio_memo=None, xbar_occupied=None, adc_reduction=None):  #### These should be 'almost' completely changed. 
 
-    # xbars shape:          [xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
+    # xbars shape:          [2, xbars_row, xbars_col, XBAR_ROW_SIZE, XBAR_COL_SIZE]
     # flatten_input shape:  [batch_size, xbars_row, XBAR_ROW_SIZE, 16]
+    # shift_add_bit_stream: [16, 1], shift_add_bit_slice: [bit_slice_num] and Goffmat: [1], broadcast at use
+    # G_proj shape:         [2, xbars_row, xbars_col, hidden] precomputed conductance half of the GENIEx fc1 (or None)
+    # niratio_memo:         LRU memo of the GENIEx ratios of the layer (see xbmodel_niratio_memo), None to disable
+    # xbar_occupied:        [2, xbars_row, xbars_col] mask of the non-zero crossbars, only these run GENIEx (None: all)
+    # adc_reduction:        [xbars_row, xbars_col, XBAR_COL_SIZE] bits of ADC reduction per crossbar column (None: adc_bit everywhere)
     # 2-bit bit-slicing
 
     Gon = cfg.Gon
@@ -254,8 +955,8 @@ def mvm_tensor_nonid(zeros, shift_add_bit_stream, shift_add_bit_slice, output_re
 
     in_diff = inmax_test-inmin_test
 
-    xbars_row = xbars.shape[0]
-    xbars_col = xbars.shape[1]
+    xbars_row = xbars.shape[1]
+    xbars_col = xbars.shape[2]
     batch_size = flatten_input.shape[0]
 
     bit_slice_num = weight_bits//bit_slice
@@ -271,96 +972,123 @@ def mvm_tensor_nonid(zeros, shift_add_bit_stream, shift_add_bit_slice, output_re
         V_real = input_split*Vmax/Nstates_stream
         V_real_scaled = (V_real-inmin_V)/(inmax_V-inmin_V)
     
+    # The positive and negative arrays are evaluated in one pass (leading dimension of G_real, G_real_flatten,
+    # output_analog and output_reg) and the function returns W+ - W-
+    if cfg.loop == False:
+        # every bit-stream (and input sign) at once, with one batched GENIEx evaluation for the layer
+        if bit_stream == 1:
+            # [2, batch_size, xbars_row, xbars_col, bit_stream_num, XBAR_COL_SIZE]
+            output_real = torch.einsum('bxrn,wxyrc->wbxync', V_real, G_real)
+            output_bias = torch.sum(torch.mul(Goffmat, V_real), 2).reshape(1, batch_size, xbars_row, 1, bit_stream_num, 1)
+            output_niratio = xbmodel_niratio(model, G_proj, G_real_flatten, V_real_scaled.permute(0,3,1,2).reshape(-1, xbars_row, XBAR_ROW_SIZE), niratio_memo, xbar_occupied)
+            output_niratio = output_niratio.reshape(2, xbars_row, xbars_col, batch_size, bit_stream_num, XBAR_COL_SIZE).permute(0,3,1,2,4,5)
+        else:
+            # [2, 2, batch_size, xbars_row, xbars_col, bit_stream_num, XBAR_COL_SIZE]
+            output_real = torch.einsum('sbxrn,wxyrc->wsbxync', V_real, G_real)
+            output_bias = torch.sum(torch.mul(Goffmat, V_real), 3).reshape(1, 2, batch_size, xbars_row, 1, bit_stream_num, 1)
+            output_niratio = xbmodel_niratio(model, G_proj, G_real_flatten, V_real_scaled.permute(0,1,4,2,3).reshape(-1, xbars_row, XBAR_ROW_SIZE), niratio_memo, xbar_occupied)
+            output_niratio = output_niratio.reshape(2, xbars_row, xbars_col, 2, batch_size, bit_stream_num, XBAR_COL_SIZE).permute(0,3,4,1,2,5,6)
+        output_niratio_unscale = (output_niratio) * in_diff + inmin_test
+        output_analog = (output_real-output_bias).div(output_niratio_unscale)*Comp_factor
+
+        output_analog = torch.round(output_analog) #ADC quantization
+        output_analog = adc_clamp(output_analog, adc_max_code(adc_bit, adc_reduction, stream_dim=True))
+        output_analog = output_analog.reshape(output_analog.shape[:-1] + (-1, bit_slice_num)).float()
+        output_reg = torch.sum(torch.mul(output_analog, shift_add_bit_slice), -1)
+        output = torch.sum(torch.mul(output_reg.flip(-2), shift_add_bit_stream), -2)    # bit-streams LSB --> MSB, as shift_add_bit_stream
+
+        output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
+        output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
+
+        # + sum xbar_rows, W+ - W-
+        if bit_stream == 1:
+            output = torch.sum(output, 2).reshape(2, batch_size, -1)
+        else:
+            output = torch.sum(output, 3).reshape(2, 2, batch_size, -1)
+            output = output[:,0].sub(output[:,1]).type(torch.float)
+        return output[0].sub(output[1])
+
     if bit_stream == 1:
         for i in range(bit_stream_num): # 16bit input
             V_real_loop = V_real[:,:,:,-1-i].reshape((batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1))   #V_real.shape batchsize, xbar_rows, xbarsize, num_bitstreams
-            V_real_scaled_loop = V_real_scaled[:,:,:,-1-i].reshape((batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1))
+            V_real_scaled_loop = V_real_scaled[:,:,:,-1-i].reshape((batch_size, xbars_row, XBAR_ROW_SIZE))
             output_bias_all = torch.sum(torch.mul(Goffmat,V_real_loop),3).unsqueeze(3).expand(batch_size, xbars_row, 1, XBAR_COL_SIZE, 1)
-            output_real_out= torch.mul(G_real, V_real_loop)
-            output_real_out = torch.sum(output_real_out,3)
-            if cfg.loop == True:
+            output_real_out = torch.einsum('bxr,wxyrc->wbxyc', V_real[:,:,:,-1-i], G_real)
+            live_rows = V_real_scaled_loop.ne(0).any(2).any(0).tolist() if cfg.skip_zero_inputs else [True]*xbars_row
+            for wsign in range(2):
                 for xrow in range(xbars_row):
                     for xcol in range(xbars_col):
-                        output_real = output_real_out[:,xrow,xcol]
-                        input_VG = torch.cat((G_real_flatten[:,xrow,xcol], V_real_scaled_loop[:, xrow, 0]),1)
-                        
-                        output_niratio = model(input_VG)
+                        if not live_rows[xrow]: # zero input: ADC codes of 0
+                            output_analog[wsign, :, xrow, xcol] = 0
+                            continue
+                        output_real = output_real_out[wsign,:,xrow,xcol]
+                        if G_proj is None:
+                            input_VG = torch.cat((G_real_flatten[wsign,xrow,xcol].expand(batch_size, -1), V_real_scaled_loop[:, xrow]),1)
+                            output_niratio = model(input_VG)
+                        else:
+                            output_niratio = model.forward_split(G_proj[wsign,xrow,xcol], V_real_scaled_loop[:, xrow])
                         output_niratio_unscale = (output_niratio) * (inmax_test - inmin_test )  + inmin_test
                         output_bias = output_bias_all[:, xrow, 0].view(batch_size,XBAR_COL_SIZE)
                         output_nonideal = (output_real-output_bias).div(output_niratio_unscale)
                         output_analog_xbar_real = ((output_nonideal)*Comp_factor)
-    
+
                         # --------------------------------------
-                        output_analog[:, xrow, xcol] = output_analog_xbar_real
-            else:
-                V_int = V_real_scaled_loop.expand(batch_size, xbars_row, xbars_col, XBAR_ROW_SIZE,1)
-                input_VG = torch.cat((G_real_flatten, V_int), 3) # concat along the input dim of XB so total inputs = r^2+r
-                output_real = output_real_out.permute(1,2,0,3).reshape(output_real_out.shape[0]*output_real_out.shape[1]*output_real_out.shape[2], output_real_out.shape[3]) # reshaped to # currents, col currents 
-                input_VG_flatten = input_VG.permute(1,2,0,3,4).reshape(batch_size*input_VG.shape[1]*input_VG.shape[2], input_VG.shape[3])
-                output_niratio = model(input_VG_flatten)
-                output_niratio_unscale = (output_niratio) * in_diff + inmin_test
-                output_bias = output_bias_all.expand(batch_size, output_bias_all.shape[1], xbars_col, XBAR_COL_SIZE, 1).permute(1,2, 0,3,4).reshape(batch_size*xbars_row*xbars_col,XBAR_ROW_SIZE)
-                output_analog_xbar = (output_real-output_bias).div(output_niratio_unscale)
-                
-                output_analog = torch.stack(torch.split(((output_analog_xbar)*Comp_factor),batch_size,dim=0)).reshape(xbars_row, xbars_col, batch_size, XBAR_COL_SIZE).permute(2,0,1,3)
-                        
+                        output_analog[wsign, :, xrow, xcol] = output_analog_xbar_real
+
             #####
             output_analog = torch.round(output_analog) #ADC quantization
-            output_analog = torch.clamp(output_analog, min=0, max=2**adc_bit-1)
-            output_analog_=output_analog.reshape(shift_add_bit_slice.shape)
+            output_analog = adc_clamp(output_analog, adc_max_code(adc_bit, adc_reduction))
+            output_analog_=output_analog.reshape(2, batch_size, xbars_row, xbars_col, -1, bit_slice_num)
             output_analog_ = output_analog_.float()
-            output_reg[:,:,:,i,:] = torch.sum(torch.mul(output_analog_, shift_add_bit_slice), 4)
+            output_reg[:,:,:,:,i,:] = torch.sum(torch.mul(output_analog_, shift_add_bit_slice), 5)
 
-        output = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 3)
+        output = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 4)
 
         output.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
         output.fmod_(2**acm_bit).div_(2**acm_bit_frac)
-        output = torch.sum(output, 1).reshape(batch_size, -1)
+        output = torch.sum(output, 2).reshape(2, batch_size, -1)
     else:
         for i in range(bit_stream_num): # 16bit input
             V_real_loop = V_real[:,:,:,:,-1-i].reshape((2, batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1))
-            V_real_scaled_loop = V_real_scaled[:,:,:,:,-1-i].reshape((2, batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1))
-            output_real_out= torch.mul(G_real, V_real_loop)
-            output_real_out = torch.sum(output_real_out,4)
+            V_real_scaled_loop = V_real_scaled[:,:,:,:,-1-i].reshape((2, batch_size, xbars_row, XBAR_ROW_SIZE))
+            output_real_out = torch.einsum('sbxr,wxyrc->wsbxyc', V_real[:,:,:,:,-1-i], G_real)
             output_bias_all = torch.sum(torch.mul(Goffmat,V_real_loop),4).unsqueeze(4).expand(2,batch_size, xbars_row, 1, XBAR_ROW_SIZE, 1)#.to(device)
+            live_rows = V_real_scaled_loop.ne(0).any(3).any(1).tolist() if cfg.skip_zero_inputs else [[True]*xbars_row]*2
 
             for xsign in range(2):
-                if cfg.loop == True:
+                for wsign in range(2):
                     for xrow in range(xbars_row):
                         for xcol in range(xbars_col):
-                            output_real = output_real_out[xsign,:,xrow,xcol]
-                            input_VG = torch.cat((G_real_flatten[:,xrow,xcol], V_real_scaled_loop[xsign, :, xrow, 0]),1)
-                            output_niratio = model(input_VG)
+                            if not live_rows[xsign][xrow]: # zero input: ADC codes of 0
+                                output_analog[wsign, xsign, :, xrow, xcol] = 0
+                                continue
+                            output_real = output_real_out[wsign,xsign,:,xrow,xcol]
+                            if G_proj is None:
+                                input_VG = torch.cat((G_real_flatten[wsign,xrow,xcol].expand(batch_size, -1), V_real_scaled_loop[xsign, :, xrow]),1)
+                                output_niratio = model(input_VG)
+                            else:
+                                output_niratio = model.forward_split(G_proj[wsign,xrow,xcol], V_real_scaled_loop[xsign, :, xrow])
                             output_niratio_unscale = (output_niratio) * in_diff  + inmin_test
                             output_bias = output_bias_all[xsign, :, xrow, 0].view(batch_size,XBAR_ROW_SIZE)
                             output_nonideal = (output_real-output_bias).div(output_niratio_unscale)
                             output_analog_xbar_real = ((output_nonideal)*Comp_factor)
-                            output_analog[xsign, :, xrow, xcol] = output_analog_xbar_real
-                else:
-                    V_int = V_real_scaled_loop.expand(2, batch_size, xbars_row, xbars_col, XBAR_ROW_SIZE,1)
-                    input_VG = torch.cat((G_real_flatten, V_int[xsign]), 3)
-                    output_real = output_real_out[xsign].permute(1,2,0,3).reshape(output_real_out.shape[1]*output_real_out.shape[2]*output_real_out.shape[3], output_real_out.shape[4])
-                    input_VG_flatten = input_VG.permute(1,2,0,3,4).reshape(batch_size*input_VG.shape[1]*input_VG.shape[2], input_VG.shape[3])
-                    output_niratio = model(input_VG_flatten)
-                    output_niratio_unscale = (output_niratio) * in_diff + inmin_test
-                    output_bias = output_bias_all[xsign].expand(batch_size, output_bias_all.shape[2], xbars_col, XBAR_ROW_SIZE, 1).permute(1,2, 0,3,4).reshape(batch_size*xbars_row*xbars_col,XBAR_ROW_SIZE)
-                    output_analog_xbar = (output_real-output_bias).div(output_niratio_unscale)
-                    output_analog[xsign, :] = torch.stack(torch.split(((output_analog_xbar)*Comp_factor),batch_size,dim=0)).reshape(xbars_row, xbars_col, batch_size, XBAR_COL_SIZE).permute(2,0,1,3)
+                            output_analog[wsign, xsign, :, xrow, xcol] = output_analog_xbar_real
             
             output_analog = torch.round(output_analog) #ADC quantization
-            output_analog = torch.clamp(output_analog, min=0, max=2**adc_bit-1)
-            output_analog_ = output_analog.reshape(shift_add_bit_slice.shape)
+            output_analog = adc_clamp(output_analog, adc_max_code(adc_bit, adc_reduction))
+            output_analog_ = output_analog.reshape(2, 2, batch_size, xbars_row, xbars_col, -1, bit_slice_num)
             output_analog_ = output_analog_.float()
-            output_reg[:,:,:,:,i,:] = torch.sum(torch.mul(output_analog_, shift_add_bit_slice), 5) # -1
+            output_reg[:,:,:,:,:,i,:] = torch.sum(torch.mul(output_analog_, shift_add_bit_slice), 6) # -1
         
-        output_split = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 4)
+        output_split = torch.sum(torch.mul(output_reg, shift_add_bit_stream), 5)
 
         output_split.div_(2**(input_bit_frac + weight_bit_frac - acm_bit_frac)).trunc_()
         output_split.fmod_(2**acm_bit).div_(2**acm_bit_frac)
 
         # + sum xbar_rows
-        output_split = torch.sum(output_split, 2).reshape(2, batch_size, -1)
-        output = output_split[0].sub(output_split[1]).type(torch.float)
+        output_split = torch.sum(output_split, 3).reshape(2, 2, batch_size, -1)
+        output = output_split[:,0].sub(output_split[:,1]).type(torch.float)
     
+    # W+ - W-
     #del shift_add_bit_stream, shift_add_bit_slice, output_reg
-    return output
+    return output[0].sub(output[1])
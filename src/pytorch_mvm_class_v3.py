@@ -8,6 +8,7 @@ import math
 import numpy as np
 import pdb
 import time
+import warnings
 import sys
 torch.set_printoptions(threshold=10000)
 
@@ -21,14 +22,13 @@ class Conv2d_mvm_function(Function):
     # +--------------------------+
     # |            MVM           |   
     # +--------------------------+
-    def forward(ctx, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, bit_slice=2, bit_stream=1, weight_bits=16, weight_bit_frac=-1, input_bits=16, input_bit_frac=-1, adc_bit=-1, acm_bits=16, acm_bit_frac=-1, tile_row=2, tile_col=2, xbmodel=None, xbmodel_weight_path=None):
+    def forward(ctx, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, bit_slice=2, bit_stream=1, weight_bits=16, weight_bit_frac=-1, input_bits=16, input_bit_frac=-1, adc_bit=-1, acm_bits=16, acm_bit_frac=-1, tile_row=2, tile_col=2, xbmodel=None, xbmodel_weight_path=None, xbar_cache=None, workspace=None):
        
         #torch.set_default_tensor_type(torch.HalfTensor) #uncomment for FP16
         ## fixed-16: 
         ## sign     : 1 
         ## integer  : 3
         ## fraction : 12
-        num_pixel = tile_row*tile_col
         if weight_bit_frac == -1:
             weight_bit_frac = weight_bits//4*3
         if input_bit_frac == -1:
@@ -47,139 +47,121 @@ class Conv2d_mvm_function(Function):
         weight_channels_in = weight.shape[1]
         weight_row = weight.shape[2]
         weight_col = weight.shape[3]
-        length = weight_channels_in * weight_row * weight_col
-        flatten_weight = torch.zeros(2, weight_channels_out, length).to(device)     ## W+ / W-
-    
-        weight_temp = weight.reshape((weight_channels_out, length))
-        flatten_weight[0] = torch.clamp(weight_temp, min=0)  ## flatten weights
-        flatten_weight[1] = torch.clamp(weight_temp, max=0).abs()
-        pos_bit_slice_weight = bit_slicing(flatten_weight[0], weight_bit_frac, bit_slice, weight_bits).to(device) ## v2: flatten weights --> fixed point --> bit slice -- v1
-        neg_bit_slice_weight = bit_slicing(flatten_weight[1], weight_bit_frac, bit_slice, weight_bits).to(device) 
-
-        xbar_row = math.ceil(pos_bit_slice_weight.shape[0]/cfg.xbar_row_size)
-        xbar_col = math.ceil(pos_bit_slice_weight.shape[1]/cfg.xbar_col_size)
-
-        weight_xbar = torch.zeros((2,xbar_row*cfg.xbar_row_size, xbar_col*cfg.xbar_col_size)).to(device)
-        weight_xbar[0,:pos_bit_slice_weight.shape[0], :pos_bit_slice_weight.shape[1]] = pos_bit_slice_weight
-        weight_xbar[1,:neg_bit_slice_weight.shape[0], :neg_bit_slice_weight.shape[1]] = neg_bit_slice_weight
+
+        xbar_state = get_programmed_xbars(xbar_cache, weight, bit_slice, weight_bits, weight_bit_frac, xbmodel)
+        xbars = xbar_state['xbars']
 
         bit_slice_num = weight_bits//bit_slice
         bit_stream_num = input_bits//bit_stream
         assert (cfg.xbar_row_size > bit_slice_num), "Attempting zero division, adjust xbar_col_size"
         bias_addr = [weight_channels_out//int(cfg.xbar_col_size/bit_slice_num), weight_channels_out%int(cfg.xbar_col_size/bit_slice_num)]      #####
 
-        #xbars = weight_xbar.unfold(1,cfg.xbar_row_size, cfg.xbar_col_size).unfold(2, cfg.xbar_row_size, cfg.xbar_col_size)
-        xbars = weight_xbar.unfold(1,cfg.xbar_row_size, cfg.xbar_row_size).unfold(2, cfg.xbar_col_size, cfg.xbar_col_size)
-        
         input_batch = input.shape[0]
         input_channels = input.shape[1]     # weight_channels_in == input_channels
         input_row = input.shape[2] + padding[0]*2
         input_col = input.shape[3] + padding[1]*2
-        input_pad = torch.zeros((input_batch, input_channels, input_row, input_col)).to(device)
+        input_pad = get_workspace(workspace, 'input_pad', (input_batch, input_channels, input_row, input_col), device)
         input_pad[:,:,padding[0]:input_row-padding[0],padding[1]:input_col-padding[1]] = input
-        pos = torch.ones(input_batch*num_pixel, input_channels*weight_row*weight_col).to(device)
-        neg = pos.clone().fill_(0)
 
         output_row = (input_row - weight_row)//stride[0] + 1
         output_col = (input_col - weight_col)//stride[1] + 1 
-        output = torch.zeros((input_batch, weight_channels_out, output_row, output_col)).to(device)
 
-        flatten_binary_input = torch.zeros(input_batch*num_pixel, xbars.shape[1]*cfg.xbar_row_size, bit_stream_num).to(device)
-        flatten_input_sign_temp = torch.zeros(input_batch*num_pixel, xbars.shape[1]*cfg.xbar_row_size, bit_stream_num).to(device)
-        flatten_input_sign_xbar= torch.zeros(input_batch*num_pixel, xbars.shape[1],cfg.xbar_row_size, bit_stream_num).to(device)
-        
+        # Output feature map size should be multiple of tile size. Tiling only matters to the hardware model (the MVM
+        # results do not depend on it), so a feature map that cannot be tiled is simulated with a warning
+        if (tile_row > output_row):
+            tile_row = output_row
+        if (tile_col > output_col):
+            tile_col = output_col
+        if output_row%tile_row != 0 or output_col%tile_col != 0:
+            warnings.warn('Output feature map {}x{} is not a multiple of the tile size {}x{}: the hardware model does not map it'
+                          .format(output_row, output_col, tile_row, tile_col))
+
         #variables transferred to GPU
-        xbars_row = xbars.shape[1]  # dimension 0 is for sign 
-        xbars_col = xbars.shape[2]
-        
-        zero_mvmtensor = torch.zeros(input_batch*num_pixel, xbars.shape[1],cfg.xbar_row_size, bit_stream_num).to(device)
+        xbars_row = xbar_state['xbars_shape'][1]  # dimension 0 is for sign 
+        xbars_col = xbar_state['xbars_shape'][2]
+        Goff = cfg.Goff
 
+        # constants are kept un-expanded and broadcast at use
+        pos = torch.ones(1).to(device)
+        neg = torch.zeros(1).to(device)
+        zero_mvmtensor = torch.zeros(1).to(device)
+        Goffmat = Goff*torch.ones(1).to(device)
         shift_add_bit_stream= torch.pow(2*torch.ones(bit_stream_num).float(), bit_stream*torch.arange(0,bit_stream_num).float()).to(device)
         shift_add_bit_slice=  torch.pow(2*torch.ones(bit_slice_num).float(),  bit_slice*torch.arange(bit_slice_num-1, -1, -1).float()).to(device)
-        Gon = cfg.Gon
-        Goff = cfg.Goff
-        Nstates_slice = 2**bit_slice-1  
-
-        if bit_stream ==1:
-            if input_bits != 1:
-                shift_add_bit_stream[-1] *= -1        # last bit --> subtract
-            shift_add_bit_stream = shift_add_bit_stream.expand((input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_stream_num)).transpose(3,4).to(device)
-            shift_add_bit_slice = shift_add_bit_slice.expand((input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_slice_num)).to(device)
-            output_reg = torch.zeros(input_batch*num_pixel, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num).float().to(device) # for 32-fixed  
-            if cfg.non_ideality == True:
-                output_analog = torch.zeros(input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size).to(device)
-                Goffmat = Goff*torch.ones(input_batch*num_pixel, xbars_row, 1, cfg.xbar_row_size, 1).to(device)
-                G_real0 = (xbars[0]*(Gon - Goff)/Nstates_slice + Goff)
-                G_real_scaled0 = (G_real0-Goff)/(Gon-Goff)                
-                G_real_flatten0 = G_real_scaled0.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten0 = G_real_flatten0.unsqueeze(3).expand(input_batch*num_pixel, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)
-                
-                G_real1 = (xbars[1]*(Gon - Goff)/Nstates_slice + Goff)
-                G_real_scaled1 = (G_real1-Goff)/(Gon-Goff)                
-                G_real_flatten1 = G_real_scaled1.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten1 = G_real_flatten1.unsqueeze(3).expand(input_batch*num_pixel, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)
+        if bit_stream == 1 and input_bits != 1:
+            shift_add_bit_stream[-1] *= -1        # last bit --> subtract
+        shift_add_bit_stream = shift_add_bit_stream.unsqueeze(1) # [bit_stream_num, 1] against output_reg [..., bit_stream_num, XBAR_COL_SIZE/bit_slice_num]
+        output_analog = None
+        if cfg.non_ideality == True:
+            G_real = xbar_state['G_real']
+            G_real_flatten = xbar_state['G_real_flatten']
 
-        else:
-            shift_add_bit_stream = shift_add_bit_stream.expand((2, input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_stream_num)).transpose(4,5).to(device)
-            shift_add_bit_slice = shift_add_bit_slice.expand((2, input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_slice_num)).to(device)
-            output_reg = torch.zeros(2, input_batch*num_pixel, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num).to(device)
-            if cfg.non_ideality == True:
-                output_analog = torch.zeros(2, input_batch*num_pixel, xbars_row, xbars_col, cfg.xbar_col_size).to(device)
-                Goffmat = Goff*torch.ones(2, input_batch*num_pixel, xbars_row, 1, cfg.xbar_row_size, 1).to(device)
-                G_real0 = (xbars[0]*(Gon - Goff)/Nstates_slice +Goff)
-                G_real_scaled0 = (G_real0-Goff)/(Gon-Goff)                
-                G_real_flatten0 = G_real_scaled0.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten0 = G_real_flatten0.unsqueeze(3).expand(input_batch*num_pixel, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)                
-
-                G_real1 = (xbars[1]*(Gon - Goff)/Nstates_slice +Goff)
-                G_real_scaled1 = (G_real1-Goff)/(Gon-Goff)                
-                G_real_flatten1 = G_real_scaled1.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten1 = G_real_flatten1.unsqueeze(3).expand(input_batch*num_pixel, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)                
-        
-        #unfold = nn.Unfold(kernel_size=(weight_row, weight_row), stride=(stride[0], stride[1]))
+        # Every output pixel is an independent MVM, so the whole feature map is unfolded once and streamed through
+        # the xbars in chunks of cfg.chunk_size (batch x output pixel) rows, or of the largest size that fits in
+        # cfg.memory_budget. Tiling only matters to the hardware model.
         unfold = nn.Unfold(kernel_size=(weight_row, weight_col), stride=(stride[0], stride[1]))
-        
-        input_patch_row = (tile_row-1)*stride[0] + weight_row
-        stride_input_row = stride[0]*tile_row
-        input_patch_col = (tile_col-1)*stride[1] + weight_col
-        stride_input_col = stride[1]*tile_col
-        
-        # Output feature map size should be multiple of tile size
-        if (tile_row > output_row):
-            tile_row = output_row
-        if (tile_col > output_col):
-            tile_col = output_col
-        assert output_row%tile_row == 0 and output_col%tile_col == 0, "Output feature map size should be multiple of tile size"
-        for i in range(math.ceil(output_row/tile_row)):
-            for j in range(math.ceil(output_col/tile_col)):
-                input_temp = unfold(input_pad[:,:, stride_input_row*i:stride_input_row*i+input_patch_row, stride_input_col*j:stride_input_col*j+input_patch_col]).permute(2,0,1).float() # #patches, batchsize, k^2*I
-                input_temp = input_temp.reshape(input_batch*num_pixel,-1)          #new_batch_size = batch_size*#_of_output_pixel    
-                if bit_stream >1:
-                    flatten_input_sign = torch.where(input_temp > 0, pos, neg).expand(bit_stream_num,-1,-1).permute(1, 2, 0) 
-                    flatten_input_sign_temp[:,:flatten_input_sign.shape[1]] = flatten_input_sign
-                    flatten_input_sign_xbar = flatten_input_sign_temp.reshape(input_batch*num_pixel, xbars.shape[1],cfg.xbar_row_size, bit_stream_num)
-                    input_temp.abs_()
-
-                flatten_binary_input_temp = float_to_16bits_tensor_fast(input_temp, input_bit_frac, bit_stream, bit_stream_num, input_bits)   # batch x n x 16
-                flatten_binary_input[:,:flatten_binary_input_temp.shape[1]] = flatten_binary_input_temp
-                flatten_binary_input_xbar = flatten_binary_input.reshape((input_batch*num_pixel, xbars.shape[1],cfg.xbar_row_size, bit_stream_num))  
-                
-                if cfg.non_ideality == True:
-                    xbars_out = mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten0, G_real0, 
-                                               xbmodel, flatten_binary_input_xbar, flatten_input_sign_xbar, bias_addr, xbars[0], bit_slice, bit_stream, weight_bits, 
-                                               weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac) - \
-                                mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten1, G_real1, 
-                                               xbmodel, flatten_binary_input_xbar, flatten_input_sign_xbar, bias_addr, xbars[1], bit_slice, bit_stream, weight_bits, 
-                                               weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac) 
+        input_unfold = unfold(input_pad).transpose(1,2).reshape(input_batch*output_row*output_col, -1).float() # batchsize*#patches, k^2*I
+        num_rows = input_unfold.shape[0]
+        chunk_rows = micro_batch_rows(num_rows, cfg.chunk_size, xbars_row, xbars_col, bit_slice, bit_stream, bit_stream_num, bit_slice_num,
+                                      input_bits, adc_bit)
+        output_flatten = torch.zeros(num_rows, weight_channels_out).to(device)
+        int_engine = use_int_engine(input_bits)
+
+        batch_rows = 0
+        for start in range(0, num_rows, chunk_rows):
+            input_temp = input_unfold[start:start+chunk_rows]          #new_batch_size = batch_size*#_of_output_pixel
+
+            if input_temp.shape[0] != batch_rows: # scratch tensors for this chunk size (at most twice: full and last chunk)
+                batch_rows = input_temp.shape[0]
+                flatten_binary_input = get_workspace(workspace, 'flatten_binary_input', (batch_rows, xbars_row*cfg.xbar_row_size, bit_stream_num), device)
+                if int_engine:
+                    flatten_input_int = get_workspace(workspace, 'flatten_input_int', (batch_rows, xbars_row*cfg.xbar_row_size), device, torch.long)
+                flatten_input_sign_temp = get_workspace(workspace, 'flatten_input_sign', (batch_rows, xbars_row*cfg.xbar_row_size, bit_stream_num), device)
+                flatten_input_sign_xbar = flatten_input_sign_temp.reshape(batch_rows, xbars_row, cfg.xbar_row_size, bit_stream_num)
+
+                if xbar_state['xbars_sparse'] is not None: # block-sparse xbars: no dense crossbar outputs
+                    output_reg = None
+                elif bit_stream ==1:
+                    output_reg = get_workspace(workspace, 'output_reg', (2, batch_rows, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num), device) # for 32-fixed  
+                    if cfg.non_ideality == True and cfg.loop == True: # per-xbar GENIEx loop only
+                        output_analog = get_workspace(workspace, 'output_analog', (2, batch_rows, xbars_row, xbars_col, cfg.xbar_col_size), device)
                 else:
-                    xbars_out = mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, flatten_binary_input_xbar, flatten_input_sign_xbar, 
-                                           bias_addr, xbars[0], bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, 
-                                           acm_bit_frac) - \
-                                mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, flatten_binary_input_xbar, flatten_input_sign_xbar,
-                                           bias_addr, xbars[1], bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, 
-                                           acm_bit_frac)
-
-                output[:,:,i*tile_row:(i+1)*tile_row,j*tile_col:(j+1)*tile_col] = xbars_out.reshape(tile_row, tile_col, input_batch, -1).permute(2,3,0,1)[:,:weight_channels_out,:,:]  ## #batchsize, # o/p channels, tile_row, tile_col 
+                    output_reg = get_workspace(workspace, 'output_reg', (2, 2, batch_rows, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num), device)
+                    if cfg.non_ideality == True and cfg.loop == True: # per-xbar GENIEx loop only
+                        output_analog = get_workspace(workspace, 'output_analog', (2, 2, batch_rows, xbars_row, xbars_col, cfg.xbar_col_size), device)
+
+            if bit_stream >1:
+                flatten_input_sign = torch.where(input_temp > 0, pos, neg).expand(bit_stream_num,-1,-1).permute(1, 2, 0) 
+                flatten_input_sign_temp[:,:flatten_input_sign.shape[1]] = flatten_input_sign
+                input_temp.abs_()
+
+            if int_engine:
+                flatten_input_int[:,:input_temp.shape[1]] = float_to_fixed_int(input_temp, input_bit_frac, input_bits)
+                xbars_out = mvm_tensor_int(flatten_input_int.reshape(batch_rows, xbars_row, cfg.xbar_row_size), flatten_input_sign_xbar[:,:,:,0],
+                                           xbar_state['xbars_int'], bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac,
+                                           adc_bit, acm_bits, acm_bit_frac, xbar_state['adc_reduction'])
+                output_flatten[start:start+batch_rows] = xbars_out[:, :weight_channels_out]
+                continue
+
+            float_to_16bits_tensor_fast(input_temp, input_bit_frac, bit_stream, bit_stream_num, input_bits, flatten_binary_input)   # batch x n x 16
+            flatten_binary_input_xbar = flatten_binary_input.reshape((batch_rows, xbars_row,cfg.xbar_row_size, bit_stream_num))  
+
+            if cfg.non_ideality == True:
+                xbars_out = mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten, G_real, 
+                                           xbmodel, flatten_binary_input_xbar, flatten_input_sign_xbar, bias_addr, xbars, bit_slice, bit_stream, weight_bits, 
+                                           weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac, xbar_state['G_proj'],
+                                           xbar_state['niratio_memo'], xbar_state['xbar_occupied'], xbar_state['adc_reduction'])
+            else:
+                xbars_out = mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, flatten_binary_input_xbar, flatten_input_sign_xbar, 
+                                       bias_addr, xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, 
+                                       acm_bit_frac, xbar_state['xbar_index'], xbar_state['xbars_occupied'], xbar_state['adc_reduction'],
+                                       xbar_state['xbars_sparse'])
+
+            output_flatten[start:start+batch_rows] = xbars_out[:, :weight_channels_out]
+
+        output = output_flatten.reshape(input_batch, output_row, output_col, -1).permute(0,3,1,2).contiguous()  ## #batchsize, # o/p channels, output_row, output_col
+        if bias is not None:
+            output += bias.reshape(1, -1, 1, 1)
         ctx.save_for_backward(input, weight, bias)
         ctx.stride = stride
         ctx.padding = padding 
@@ -215,7 +197,7 @@ class Conv2d_mvm_function(Function):
         if bias is not None and ctx.needs_input_grad[2]:
             grad_bias = grad_output.sum((0,2,3)).squeeze(0)
             
-        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None 
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None
 
 
 class _ConvNd_mvm(nn.Module):
@@ -259,6 +241,8 @@ class _ConvNd_mvm(nn.Module):
             self.xbmodel.load_state_dict(torch.load(self.xbmodel_weight_path)['state_dict'])
         self.tile_col = cfg.tile_col if cfg.ifglobal_tile_col else tile_col
         self.tile_row = cfg.tile_row if cfg.ifglobal_tile_row else tile_row
+        self.xbar_cache = {} # programmed xbars, rebuilt when the weight or config changes
+        self.workspace = {} # scratch tensors reused across forwards, keyed by name, shape and device
 
         if check_grad:
             tensor_constructor = torch.DoubleTensor # double precision required to check grad
@@ -315,7 +299,7 @@ class Conv2d_mvm(_ConvNd_mvm):
     #@weak_script_method
     def forward(self, input):
             return Conv2d_mvm_function.apply(input, self.weight, self.bias, self.stride, self.padding, self.dilation, self.groups,
-            self.bit_slice, self.bit_stream, self.weight_bits, self.weight_bit_frac, self.input_bits, self.input_bit_frac, self.adc_bit, self.acm_bits, self.acm_bit_frac, self.tile_row, self.tile_col, self.xbmodel, self.xbmodel_weight_path)
+            self.bit_slice, self.bit_stream, self.weight_bits, self.weight_bit_frac, self.input_bits, self.input_bit_frac, self.adc_bit, self.acm_bits, self.acm_bit_frac, self.tile_row, self.tile_col, cfg.geniex_inference_model(self.xbmodel), self.xbmodel_weight_path, self.xbar_cache, self.workspace)
 
 
 class Linear_mvm_function(Function):
@@ -324,7 +308,7 @@ class Linear_mvm_function(Function):
     @staticmethod
     # bias is an optional argument
     def forward(ctx, input, weight, bias=None, 
-                bit_slice=2, bit_stream=1, weight_bits=16, weight_bit_frac=-1, input_bits=16, input_bit_frac=-1, adc_bit=-1, acm_bits=16, acm_bit_frac=-1, xbmodel=None, xbmodel_weight_path=None):
+                bit_slice=2, bit_stream=1, weight_bits=16, weight_bit_frac=-1, input_bits=16, input_bit_frac=-1, adc_bit=-1, acm_bits=16, acm_bit_frac=-1, xbmodel=None, xbmodel_weight_path=None, xbar_cache=None, workspace=None):
 
         #torch.set_default_tensor_type(torch.HalfTensor) #uncomment for FP16
 
@@ -343,117 +327,100 @@ class Linear_mvm_function(Function):
         device = input.device
         weight_channels_out = weight.shape[0]
         weight_channels_in = weight.shape[1]
-        pos_weight = torch.clamp(weight, min=0)
-        neg_weight = torch.clamp(weight, max=0).abs()
-
-        pos_bit_slice_weight = bit_slicing(pos_weight, weight_bit_frac, bit_slice, weight_bits) ## v2: flatten weights --> fixed point --> bit slice -- v1
-        neg_bit_slice_weight = bit_slicing(neg_weight, weight_bit_frac, bit_slice, weight_bits) ## 
-
-        # bitsliced weight into 128x128 xbars 
-        # xbar_row separates inputs --> results in a same column with different rows will be added later
-        xbar_row = math.ceil(pos_bit_slice_weight.shape[0]/cfg.xbar_row_size)
-        xbar_col = math.ceil(pos_bit_slice_weight.shape[1]/cfg.xbar_col_size)
-
-        weight_xbar = torch.zeros((2,xbar_row*cfg.xbar_row_size, xbar_col*cfg.xbar_col_size)).to(device)
-        weight_xbar[0,:pos_bit_slice_weight.shape[0], :pos_bit_slice_weight.shape[1]] = pos_bit_slice_weight
-        weight_xbar[1,:neg_bit_slice_weight.shape[0], :neg_bit_slice_weight.shape[1]] = neg_bit_slice_weight
-
-        xbars = torch.zeros((2,xbar_row, xbar_col, cfg.xbar_row_size, cfg.xbar_col_size)).to(device)
+        xbar_state = get_programmed_xbars(xbar_cache, weight, bit_slice, weight_bits, weight_bit_frac, xbmodel)
+        xbars = xbar_state['xbars']
 
         bit_slice_num = weight_bits//bit_slice
         bit_stream_num = input_bits//bit_stream
 
         bias_addr = [weight_channels_out//int(cfg.xbar_col_size/bit_slice_num), weight_channels_out%int(cfg.xbar_col_size/bit_slice_num)]      #####
-        for i in range(xbar_row):
-            for j in range(xbar_col):
-                for k in range(2):
-                    xbars[k,i,j] = weight_xbar[k,i*cfg.xbar_row_size:(i+1)*cfg.xbar_row_size, j*cfg.xbar_col_size:(j+1)*cfg.xbar_col_size]
-
         input_batch = input.shape[0]
         input_channels = input.shape[1]     # weight_channels_in == input_channels
-        pos = torch.ones(input.shape).to(device)
-        neg = pos.clone().fill_(0)      
-
-        binary_input = torch.zeros(input_batch, xbars.shape[1]*cfg.xbar_row_size, bit_stream_num).to(device)
-        input_sign_temp = torch.zeros(input_batch, xbars.shape[1]*cfg.xbar_row_size, bit_stream_num).to(device)
-        input_sign_xbar = torch.zeros(input_batch, xbars.shape[1],cfg.xbar_row_size, bit_stream_num).to(device)
-        
-        if bit_stream > 1:
-            input_sign = torch.where(input > 0, pos, neg).expand(bit_stream_num, -1, -1).permute(1,2,0)
-            input_sign_temp[:,:input_sign.shape[1]] = input_sign
-            input_sign_xbar = input_sign_temp.reshape(input_batch, xbars.shape[1],cfg.xbar_row_size, bit_stream_num)
-            input.abs_()
-
-        input = input.float()
-
-        binary_input[:,:input.shape[1]] = float_to_16bits_tensor_fast(input, input_bit_frac, bit_stream, bit_stream_num, input_bits)   # batch x n x 16
+        xbars_row = xbar_state['xbars_shape'][1]
+        xbars_col = xbar_state['xbars_shape'][2]
+        int_engine = use_int_engine(input_bits)
 
-        binary_input = binary_input.reshape((input_batch, xbars.shape[1], cfg.xbar_row_size, bit_stream_num))
-        
         #initializations brought out of mvm_tensors, since they are only needed once for the output
-        xbars_row = xbars.shape[1]
-        xbars_col = xbars.shape[2]    
-         
-        zero_mvmtensor = torch.zeros(input_batch, xbars.shape[1],cfg.xbar_row_size, bit_stream_num).to(device)
+        # constants are kept un-expanded and broadcast at use
+        zero_mvmtensor = torch.zeros(1).to(device)
         shift_add_bit_stream = torch.zeros(bit_stream_num).float() # input bits = 16
         for i in range(bit_stream_num):
             shift_add_bit_stream[i] = 2**(bit_stream*i)
         shift_add_bit_slice = torch.zeros(bit_slice_num).float() # 16bit / 2bit-slice
         for i in range(bit_slice_num):
             shift_add_bit_slice[-i-1] = 2**(bit_slice*i)        
-
-        Gon = cfg.Gon
-        Goff = cfg.Goff
-        Nstates_slice = 2**bit_slice-1           
         if bit_stream ==1:
             shift_add_bit_stream[-1] *= -1        # last bit --> subtract
-            shift_add_bit_stream = shift_add_bit_stream.expand((input_batch, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_stream_num)).transpose(3,4).to(device)
-            shift_add_bit_slice = shift_add_bit_slice.expand((input_batch, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_slice_num)).to(device)
-            output_reg = torch.zeros(input_batch, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num).to(device) # for 32-fixed  
-            if cfg.non_ideality == True:
-                output_analog = torch.zeros(input_batch, xbars_row, xbars_col, cfg.xbar_col_size).to(device)
-                Goffmat = Goff*torch.ones(input_batch, xbars_row, 1, cfg.xbar_row_size, 1).to(device)
-                G_real0 = (xbars[0]*(Gon - Goff)/Nstates_slice + Goff)
-                G_real_scaled0 = (G_real0-Goff)/(Gon-Goff)                
-                G_real_flatten0 = G_real_scaled0.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten0 = G_real_flatten0.unsqueeze(3).expand(input_batch, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)
-                
-                G_real1 = (xbars[1]*(Gon - Goff)/Nstates_slice + Goff)
-                G_real_scaled1 = (G_real1-Goff)/(Gon-Goff)                
-                G_real_flatten1 = G_real_scaled1.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten1 = G_real_flatten1.unsqueeze(3).expand(input_batch, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)                          
-        else:
-            shift_add_bit_stream = shift_add_bit_stream.expand((2, input_batch, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_stream_num)).transpose(4,5).to(device)
-            shift_add_bit_slice = shift_add_bit_slice.expand((2, input_batch, xbars_row, xbars_col, cfg.xbar_col_size//bit_slice_num, bit_slice_num)).to(device)
-            output_reg = torch.zeros(2, input_batch, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num).to(device) 
-            if cfg.non_ideality == True:
-                output_analog = torch.zeros(2, input_batch, xbars_row, xbars_col, cfg.xbar_col_size).to(device)
-                Goffmat = Goff*torch.ones(2, input_batch, xbars_row, 1, cfg.xbar_row_size, 1).to(device)
-                G_real0 = (xbars[0]*(Gon - Goff)/Nstates_slice +Goff)
-                G_real_scaled0 = (G_real0-Goff)/(Gon-Goff)                
-                G_real_flatten0 = G_real_scaled0.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten0 = G_real_flatten0.unsqueeze(3).expand(input_batch, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)                
-
-                G_real1 = (xbars[1]*(Gon - Goff)/Nstates_slice +Goff)
-                G_real_scaled1 = (G_real1-Goff)/(Gon-Goff)                
-                G_real_flatten1 = G_real_scaled1.permute(0,1,3,2).reshape(xbars_row,xbars_col,cfg.xbar_row_size*cfg.xbar_col_size).to(device)
-                G_real_flatten1 = G_real_flatten1.unsqueeze(3).expand(input_batch, xbars_row,xbars_col, cfg.xbar_row_size*cfg.xbar_col_size, 1).to(device)   
-                
+        shift_add_bit_stream = shift_add_bit_stream.unsqueeze(1).to(device) # [bit_stream_num, 1] against output_reg [..., bit_stream_num, XBAR_COL_SIZE/bit_slice_num]
+        shift_add_bit_slice = shift_add_bit_slice.to(device)
+
+        Goff = cfg.Goff
+        Goffmat = Goff*torch.ones(1).to(device)
+        output_analog = None
         if cfg.non_ideality == True:
-            xbars_out = mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten0, G_real0, 
-                                       xbmodel, binary_input, input_sign_xbar, bias_addr, xbars[0], bit_slice, bit_stream, weight_bits, weight_bit_frac, 
-                                       input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac) - \
-                        mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten1, G_real1, 
-                                       xbmodel, binary_input, input_sign_xbar, bias_addr, xbars[1], bit_slice, bit_stream, weight_bits, weight_bit_frac, 
-                                       input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac)
+            G_real = xbar_state['G_real']
+            G_real_flatten = xbar_state['G_real_flatten']
+
+        # the batch goes through the xbars at once, or in micro-batches of the largest size that fits in cfg.memory_budget
+        chunk_rows = micro_batch_rows(input_batch, 0, xbars_row, xbars_col, bit_slice, bit_stream, bit_stream_num, bit_slice_num,
+                                      input_bits, adc_bit)
+        output = torch.zeros(input_batch, weight_channels_out).to(device)
+
+        batch_rows = 0
+        for start in range(0, input_batch, chunk_rows):
+            input_temp = input[start:start+chunk_rows]
+
+            if input_temp.shape[0] != batch_rows: # scratch tensors for this chunk size (at most twice: full and last chunk)
+                batch_rows = input_temp.shape[0]
+                binary_input = get_workspace(workspace, 'binary_input', (batch_rows, xbars_row*cfg.xbar_row_size, bit_stream_num), device)
+                input_sign_temp = get_workspace(workspace, 'input_sign', (batch_rows, xbars_row*cfg.xbar_row_size, bit_stream_num), device)
+                input_sign_xbar = input_sign_temp.reshape(batch_rows, xbars_row, cfg.xbar_row_size, bit_stream_num)
+                if int_engine:
+                    input_int = get_workspace(workspace, 'input_int', (batch_rows, xbars_row*cfg.xbar_row_size), device, torch.long)
+
+                if xbar_state['xbars_sparse'] is not None: # block-sparse xbars: no dense crossbar outputs
+                    output_reg = None
+                elif bit_stream ==1:
+                    output_reg = get_workspace(workspace, 'output_reg', (2, batch_rows, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num), device) # for 32-fixed  
+                    if cfg.non_ideality == True and cfg.loop == True: # per-xbar GENIEx loop only
+                        output_analog = get_workspace(workspace, 'output_analog', (2, batch_rows, xbars_row, xbars_col, cfg.xbar_col_size), device)
+                else:
+                    output_reg = get_workspace(workspace, 'output_reg', (2, 2, batch_rows, xbars_row, xbars_col, bit_stream_num, cfg.xbar_col_size//bit_slice_num), device) 
+                    if cfg.non_ideality == True and cfg.loop == True: # per-xbar GENIEx loop only
+                        output_analog = get_workspace(workspace, 'output_analog', (2, 2, batch_rows, xbars_row, xbars_col, cfg.xbar_col_size), device)
 
-        else:
-            xbars_out = mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, binary_input, input_sign_xbar, bias_addr, xbars[0],
-                                   bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac) - \
-                        mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, binary_input, input_sign_xbar, bias_addr, xbars[1], 
-                                   bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac)
+            if bit_stream > 1:
+                input_sign = torch.where(input_temp > 0, torch.ones(1).to(device), torch.zeros(1).to(device)).expand(bit_stream_num, -1, -1).permute(1,2,0)
+                input_sign_temp[:,:input_sign.shape[1]] = input_sign
+                input_temp = input_temp.abs() # not in place: input_temp is a view of the layer input
+
+            input_temp = input_temp.float()
+
+            if int_engine:
+                input_int[:,:input_temp.shape[1]] = float_to_fixed_int(input_temp, input_bit_frac, input_bits)
+            else:
+                float_to_16bits_tensor_fast(input_temp, input_bit_frac, bit_stream, bit_stream_num, input_bits, binary_input)   # batch x n x 16
+            binary_input_xbar = binary_input.reshape((batch_rows, xbars_row, cfg.xbar_row_size, bit_stream_num))
 
-        output = xbars_out[:, :weight_channels_out]
+            if cfg.non_ideality == True:
+                xbars_out = mvm_tensor_nonid(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, output_analog, Goffmat, G_real_flatten, G_real, 
+                                           xbmodel, binary_input_xbar, input_sign_xbar, bias_addr, xbars, bit_slice, bit_stream, weight_bits, weight_bit_frac, 
+                                           input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac, xbar_state['G_proj'],
+                                           xbar_state['niratio_memo'], xbar_state['xbar_occupied'], xbar_state['adc_reduction'])
+
+            elif int_engine:
+                xbars_out = mvm_tensor_int(input_int.reshape(batch_rows, xbars_row, cfg.xbar_row_size), input_sign_xbar[:,:,:,0], xbar_state['xbars_int'],
+                                           bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac,
+                                           xbar_state['adc_reduction'])
+
+            else:
+                xbars_out = mvm_tensor(zero_mvmtensor, shift_add_bit_stream, shift_add_bit_slice, output_reg, binary_input_xbar, input_sign_xbar, bias_addr, xbars,
+                                       bit_slice, bit_stream, weight_bits, weight_bit_frac, input_bits, input_bit_frac, adc_bit, acm_bits, acm_bit_frac,
+                                       xbar_state['xbar_index'], xbar_state['xbars_occupied'], xbar_state['adc_reduction'], xbar_state['xbars_sparse'])
+
+            output[start:start+batch_rows] = xbars_out[:, :weight_channels_out]
+
+        input = input.float()
  
         if bias is not None:
             output += bias.unsqueeze(0).expand_as(output)
@@ -475,7 +442,7 @@ class Linear_mvm_function(Function):
         if bias is not None and ctx.needs_input_grad[2]:
             grad_bias = grad_output.sum(0).squeeze(0)
 
-        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None, None 
+        return grad_input, grad_weight, grad_bias, None, None, None, None, None, None, None, None, None, None, None, None, None
 
 class Linear_mvm(nn.Module):
     def __init__(self, in_features, out_features, bias=True,
@@ -506,12 +473,17 @@ class Linear_mvm(nn.Module):
         if (cfg.non_ideality):
             assert (self.xbmodel != None)
             assert (self.xbmodel_weight_path != None)
-            self.xbmodel.load_state_dict(torch.load(cfg.xbmodel_weight_path)['state_dict'])
+            self.xbmodel.load_state_dict(torch.load(self.xbmodel_weight_path)['state_dict'])
+        self.xbar_cache = {} # programmed xbars, rebuilt when the weight or config changes
+        self.workspace = {} # scratch tensors reused across forwards, keyed by name, shape and device
 
     def forward(self, input):
         # See the autograd section for explanation of what happens here.
-        return Linear_mvm_function.apply(input, self.weight, self.bias, 
-        self.bit_slice, self.bit_stream, self.weight_bits, self.weight_bit_frac, self.input_bits, self.input_bit_frac, self.adc_bit, self.acm_bits, self.acm_bit_frac, self.xbmodel, self.xbmodel_weight_path)
+        # [*, in_features] inputs (as nn.Linear) are run as a [N, in_features] batch
+        shape = input.shape[:-1]
+        output = Linear_mvm_function.apply(input.reshape(-1, self.in_features), self.weight, self.bias,
+        self.bit_slice, self.bit_stream, self.weight_bits, self.weight_bit_frac, self.input_bits, self.input_bit_frac, self.adc_bit, self.acm_bits, self.acm_bit_frac, cfg.geniex_inference_model(self.xbmodel), self.xbmodel_weight_path, self.xbar_cache, self.workspace)
+        return output.reshape(shape + (self.out_features,))
 
     def extra_repr(self):
         # (Optional)Set the extra information about this module. You can test
@@ -19,9 +19,11 @@ sys.path.insert(0, datasets_dir)
 import numpy as np
 import random
 import argparse
+import json
 import pdb
 
 import torch
+import torch.multiprocessing as mp
 import torchvision
 import torchvision.transforms as transforms
 import torch.nn as nn
@@ -37,6 +39,8 @@ from utils.data import get_dataset
 from utils.preprocess import get_transform
 from utils.utils import *
 import src.config as cfg
+from src.layer_cache import LayerOutputCache, batch_indices
+from src.convert import convert_to_mvm, check_conversion
 
 if cfg.if_bit_slicing and not cfg.dataset:
     from src.pytorch_mvm_class_v3 import *
@@ -63,18 +67,27 @@ for path, dirs, files in os.walk(models_dir):
 model_names.sort()
 
 # Run evaluation on a model (<model>.py) without functional simulator
-def test(device):
+def test(device, meters=None):
     global best_acc
     flag = True
     training = False
     model.eval()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    if meters is None:
+        meters = (AverageMeter(), AverageMeter(), AverageMeter())
+    losses, top1, top5 = meters
 
     for batch_idx,(data, target) in enumerate(testloader):
+        record = results.get(testloader, batch_idx, data.size(0)) if results is not None else None
+        if record is not None: # finished by an earlier run with the same configuration
+            losses.update(record['loss'], record['n'])
+            top1.update(record['prec1'], record['n'])
+            top5.update(record['prec5'], record['n'])
+            continue
+
         data_var = data.to(device)
         target_var = target.to(device)
+        if layer_cache is not None:
+            layer_cache.indices = batch_indices(testloader, batch_idx, data.size(0))
         
         output = model(data_var)
         loss= criterion(output, target_var)
@@ -82,6 +95,8 @@ def test(device):
         losses.update(loss.data, data.size(0))
         top1.update(prec1[0], data.size(0))
         top5.update(prec5[0], data.size(0))
+        if results is not None:
+            results.append(testloader, batch_idx, output.data, target_var.data, loss.data, prec1[0], prec5[0])
 
         if flag == True:
             if batch_idx % 1 == 0:
@@ -107,6 +122,22 @@ def test(device):
     acc = top1.avg
     return acc, losses.avg
 
+# Per-batch results log of a resumable evaluation (--results)
+results = None
+# Disk cache of the model stage outputs (--layer-cache)
+layer_cache = None
+
+# Process-pool worker (--procs): evaluates one shard of the test set with its own (forked) copy of the model
+def test_shard(rank):
+    global testloader
+    threads = setup_eval_worker(rank, len(test_shards), args.threads)
+    print('==> Worker', rank, ':', len(test_shards[rank]), 'images,', threads, 'thread(s)')
+    # pool workers are daemonic and cannot start data loading processes
+    testloader = torch.utils.data.DataLoader(test_shards[rank], batch_size=args.batch_size, shuffle=False, num_workers=0)
+    meters = (AverageMeter(), AverageMeter(), AverageMeter())
+    test(device, meters)
+    return meters
+
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', '--batch-size', default=512, type=int,
@@ -114,8 +145,7 @@ if __name__=='__main__':
     parser.add_argument('--dataset', metavar='DATASET', default='cifar100',
                 help='dataset name or folder')
     parser.add_argument('--model', '-a', metavar='MODEL', default='resnet20',
-                choices=model_names,
-                help='name of the model')
+                help='name of the model: one of '+', '.join(model_names)+' (or a torchvision model with --convert)')
     parser.add_argument('--pretrained', action='store', default=None,
         help='the path to the pretrained model')
     parser.add_argument('--mvm', action='store_true', default=None,
@@ -125,6 +155,18 @@ if __name__=='__main__':
     parser.add_argument('-j', '--workers', default=4, type=int, metavar='J',
                 help='number of data loading workers (default: 8)')
     parser.add_argument('--gpus', default='0', help='gpus (default: 8)')
+    parser.add_argument('--procs', default=1, type=int, metavar='P',
+                help='CPU evaluation processes, each on a shard of whole mini-batches of the test set (default: 1)')
+    parser.add_argument('--threads', default=0, type=int, metavar='T',
+                help='intra-op threads per evaluation process (default: 0, cores/procs)')
+    parser.add_argument('--results', default=None, metavar='FILE',
+                help='append-only per-batch results file: a restarted evaluation skips the batches finished with the same configuration')
+    parser.add_argument('--layer-cache', default=None, metavar='DIR',
+                help='folder caching the stage outputs of the model: stages whose upstream configuration is unchanged are not recomputed')
+    parser.add_argument('--convert', action='store_true', default=False,
+                help='build the mvm model by converting the float model (src/convert.py) instead of <model>_mvm.py')
+    parser.add_argument('--layer-config', default=None, metavar='JSON',
+                help='with --convert: per-layer settings {"<module name pattern>": {"adc_bit": 6, ...} or null for float}, JSON string or file')
     parser.add_argument('-exp', '--experiment', default='16x16', metavar='N',
                 help='experiment name')
     args = parser.parse_args()
@@ -137,14 +179,20 @@ if __name__=='__main__':
     print('GPU Id(s) being used:', args.gpus)
 
     print('==> Building model and model_mvm for', args.model, '...')
-    if (args.model in model_names and args.model+'_mvm' in model_names):
-        model = (__import__(args.model)) #import module using the string/variable_name
-        model_mvm = (__import__(args.model+'_mvm'))
+    if args.model in model_names:
+        model = (__import__(args.model)).net() #import module using the string/variable_name
+    elif args.convert and args.model in torchvision.models.__dict__:
+        model = torchvision.models.__dict__[args.model](num_classes=100)
     else:
-        raise Exception(args.model+'is currently not supported')
-    
-    model = model.net()
-    model_mvm = model_mvm.net(cfg.non_ideality)
+        raise Exception(args.model+' is currently not supported')
+    if args.convert:
+        model_mvm = None # converted from model after loading the pretrained weights
+    elif args.model+'_mvm' in model_names:
+        model_mvm = (__import__(args.model+'_mvm')).net(cfg.non_ideality)
+    else:
+        raise Exception(args.model+'_mvm is not a model, use --convert')
+    if args.layer_config and not args.convert:
+        raise Exception('--layer-config requires --convert')
     #print(model_mvm)
 
     print('==> Initializing model parameters ...')
@@ -162,6 +210,18 @@ if __name__=='__main__':
         pretrained_model = torch.load(args.pretrained)
         best_acc = pretrained_model['best_acc']
         model.load_state_dict(pretrained_model['state_dict'])
+
+    if args.convert:
+        # the mvm layers share the parameters and buffers of model (no weight copies)
+        layer_configs = {}
+        if args.layer_config:
+            if os.path.isfile(args.layer_config):
+                with open(args.layer_config) as f:
+                    layer_configs = json.load(f)
+            else:
+                layer_configs = json.loads(args.layer_config)
+        model_mvm = convert_to_mvm(model, layer_configs)
+    else:
         for m in model.modules():
             if isinstance(m, nn.Conv2d):
                 weights_conv.append(m.weight.data.clone())
@@ -175,28 +235,39 @@ if __name__=='__main__':
                 num_batches.append(m.num_batches_tracked.clone())
             elif isinstance(m, nn.Linear):
                 weights_lin.append(m.weight.data.clone())
-
-    i=j=k=0
-    for m in model_mvm.modules():
-        if isinstance(m, (Conv2d_mvm, nn.Conv2d)):
-            m.weight.data = weights_conv[i]
-            i = i+1
-        #print(m.weight.data)
-        #raw_input()
-        elif isinstance(m, nn.BatchNorm2d) or isinstance(m, nn.BatchNorm1d):
-            m.weight.data = bn_data[j]
-            m.bias.data = bn_bias[j]
-            m.running_mean.data = running_mean[j]
-            m.running_var.data = running_var[j]
-            m.num_batches_tracked = num_batches[j]
-            j = j+1
-        elif isinstance(m, Linear_mvm):
-            m.weight.data = weights_lin[k]
-            k=k+1
+        i=j=k=0
+        for m in model_mvm.modules():
+            if isinstance(m, (Conv2d_mvm, nn.Conv2d)):
+                m.weight.data = weights_conv[i]
+                i = i+1
+            #print(m.weight.data)
+            #raw_input()
+            elif isinstance(m, nn.BatchNorm2d) or isinstance(m, nn.BatchNorm1d):
+                m.weight.data = bn_data[j]
+                m.bias.data = bn_bias[j]
+                m.running_mean.data = running_mean[j]
+                m.running_var.data = running_var[j]
+                m.num_batches_tracked = num_batches[j]
+                j = j+1
+            elif isinstance(m, Linear_mvm):
+                m.weight.data = weights_lin[k]
+                k=k+1
 
     # Move required model to GPU (if applicable)
     if args.mvm:
         model = model_mvm
+
+    if args.results:
+        run_config = {'script': 'pytorch_sample_cifar100', 'model': args.model, 'mvm': args.mvm, 'dataset': args.dataset,
+                      'input_size': args.input_size, 'weights': state_dict_hash(model), 'layers': mvm_layer_config(model)}
+        results = EvalResultsLog(args.results, cfg.config_hash(run_config))
+        print('==> Results log', args.results, 'config', results.config, ':', len(results.results), 'finished batches')
+    
+    if args.layer_cache:
+        if not hasattr(model, 'layer_cache'):
+            raise Exception(args.model+' has no layer cache points')
+        if args.procs > 1:
+            raise Exception('--layer-cache cannot be used with --procs')
     
     model.to(device)#.half() # uncomment for FP16
     model = torch.nn.DataParallel(model)
@@ -215,6 +286,9 @@ if __name__=='__main__':
     #    num_workers=args.workers, pin_memory=True)
 
     test_data = get_dataset(args.dataset, 'val', transform['eval'])
+    if args.layer_cache:
+        layer_cache = LayerOutputCache(args.layer_cache, len(test_data))
+        model.module.layer_cache = layer_cache
     testloader = torch.utils.data.DataLoader(
         test_data,
         batch_size=args.batch_size, shuffle=False,
@@ -222,9 +296,33 @@ if __name__=='__main__':
 
     criterion = nn.CrossEntropyLoss()
 
+    if args.convert and args.mvm:
+        # converted layers against their float conv/linear on the first test batch (fixed-point error expected)
+        data, _ = next(iter(testloader))
+        errors = check_conversion(model.module, data.to(device))
+        print('==> Converted layers, max |mvm - float| on the first batch:')
+        for name, error in errors.items():
+            print('   ', name, '%.3e' % error)
+
     begin = time.time()
 
-    test(device)
+    if args.procs > 1:
+        if device.type != 'cpu':
+            raise Exception('--procs is for CPU evaluation, CUDA cannot be used in forked workers')
+        test_shards = shard_dataset(test_data, args.procs, args.batch_size)
+        with mp.get_context('fork').Pool(len(test_shards)) as pool:
+            shard_meters = pool.map(test_shard, range(len(test_shards)), chunksize=1)
+        losses, top1, top5 = shard_meters[0]
+        for meters in shard_meters[1:]:
+            losses.merge(meters[0])
+            top1.merge(meters[1])
+            top5.merge(meters[2])
+        print(' * {0} processes: Loss {loss.avg:.4f} Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
+              .format(len(test_shards), loss=losses, top1=top1, top5=top5))
+    else:
+        test(device)
+    if layer_cache is not None:
+        print('==> Layer cache', args.layer_cache, ':', layer_cache.hits, 'hits,', layer_cache.misses, 'misses')
     end = time.time()
     print('Total time:',end-begin)
     exit(0)
\ No newline at end of file
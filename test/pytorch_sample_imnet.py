@@ -1,22 +1,28 @@
+import os
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
 import torch
+import torch.multiprocessing as mp
 import torchvision
 import torchvision.transforms as transforms
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-import sys
 import pdb
 import models
-from pytorch_mvm_class_v2 import *
-import os
+import src.config as cfg
+from src.pytorch_mvm_class_v3 import *
 import argparse
-from data import get_dataset
-from preprocess import get_transform
+from utils.data import get_dataset
+from utils.preprocess import get_transform
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 import torch.distributed as dist
 import torch.utils.data.distributed
-from utils import *
+from utils.utils import *
 from torchvision.utils import save_image
 os.environ['CUDA_VISIBLE_DEVICES']= '1'
 
@@ -53,8 +59,8 @@ def test():
 
 
     for batch_idx,(data, target) in enumerate(testloader):
-        target = target.cuda()
-        data_var = torch.autograd.Variable(data.cuda(), volatile=True)
+        target = target.to(device)
+        data_var = torch.autograd.Variable(data.to(device), volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
         if batch_idx>=0 and batch_idx<20:                            
@@ -98,21 +104,28 @@ def test():
     # print('Best Accuracy: {:.2f}%\n'.format(best_acc))
     return acc, losses.avg
 
-def test_mvm():
+def test_mvm(meters=None):
     global best_acc
     flag = True
     training = False
     model_mvm.eval()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    if meters is None:
+        meters = (AverageMeter(), AverageMeter(), AverageMeter())
+    losses, top1, top5 = meters
 
     for batch_idx,(data, target) in enumerate(testloader):
-        target = target.cuda()
-        data_var = torch.autograd.Variable(data.cuda(), volatile=True)
+        target = target.to(device)
+        data_var = torch.autograd.Variable(data.to(device), volatile=True)
         target_var = torch.autograd.Variable(target, volatile=True)
 
-        if batch_idx>=13 and batch_idx<20:                            
+        record = None
+        if results is not None and batch_idx>=mvm_batches[0] and batch_idx<mvm_batches[1]:
+            record = results.get(testloader, batch_idx, data.size(0))
+        if record is not None: # finished by an earlier run with the same configuration
+            losses.update(record['loss'], record['n'])
+            top1.update(record['prec1'], record['n'])
+            top5.update(record['prec5'], record['n'])
+        elif batch_idx>=mvm_batches[0] and batch_idx<mvm_batches[1]:
             output = model_mvm(data_var)
             loss= criterion(output, target_var)
 
@@ -120,6 +133,8 @@ def test_mvm():
             losses.update(loss.data, data.size(0))
             top1.update(prec1[0], data.size(0))
             top5.update(prec5[0], data.size(0))
+            if results is not None:
+                results.append(testloader, batch_idx, output.data, target, loss.data, prec1[0], prec5[0])
             if flag == True:
                 if batch_idx % 1 == 0:
                     print('[{0}/{1}({2:.0f}%)]\t'
@@ -136,7 +151,7 @@ def test_mvm():
                           'Prec@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
                            epoch, batch_idx, len(testloader), 100. *float(batch_idx)/len(testloader),
                            loss=losses, top1=top1, top5=top5))  
-        if batch_idx == 19:
+        if batch_idx == mvm_batches[1]-1:
             break
 
     acc = top1.avg
@@ -152,7 +167,22 @@ def test_mvm():
     # print('Best Accuracy: {:.2f}%\n'.format(best_acc))
     return acc, losses.avg
 
-
+# Process-pool worker (--procs): evaluates one shard of the validation set with its own (forked) copy of model_mvm
+def test_mvm_shard(rank):
+    global testloader, mvm_batches
+    threads = setup_eval_worker(rank, len(test_shards), args.threads)
+    print('==> Worker', rank, ':', len(test_shards[rank]), 'images,', threads, 'thread(s)')
+    # pool workers are daemonic and cannot start data loading processes
+    testloader = torch.utils.data.DataLoader(test_shards[rank], batch_size=args.batch_size, shuffle=False, num_workers=0)
+    mvm_batches = (0, len(testloader))
+    meters = (AverageMeter(), AverageMeter(), AverageMeter())
+    test_mvm(meters)
+    return meters
+
+# batches [first, last) of the validation set evaluated by test_mvm
+mvm_batches = (13, 20)
+# Per-batch results log of a resumable test_mvm evaluation (--results)
+results = None
 
 ## To Indranil & Mustafa: This is for using 'for loops' in mvm_tensor. Just execute with '-i' at command line
 # ind = False
@@ -188,7 +218,14 @@ if __name__=='__main__':
                 help='gpu index (default: 8)')
     parser.add_argument('-exp', '--experiment', default='16x16', metavar='N',
                 help='experiment name')
+    parser.add_argument('--procs', default=1, type=int, metavar='P',
+                help='CPU processes evaluating model_mvm on the whole validation set, each on a shard of whole mini-batches (default: 1)')
+    parser.add_argument('--threads', default=0, type=int, metavar='T',
+                help='intra-op threads per evaluation process (default: 0, cores/procs)')
+    parser.add_argument('--results', default=None, metavar='FILE',
+                help='append-only per-batch results file of model_mvm: a restarted evaluation skips the batches finished with the same configuration')
     args = parser.parse_args()
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     # os.environ['CUDA_VISIBLE_DEVICES']= str(args.cuda_gpu)
     
     if args.i == 'True':
@@ -281,8 +318,13 @@ if __name__=='__main__':
         elif isinstance(m, Linear_mvm):
             m.weight.data = weights_lin[k]
             k=k+1
-    model.cuda()
-    model_mvm.cuda()
+    model.to(device)
+    model_mvm.to(device)
+    if args.results:
+        run_config = {'script': 'pytorch_sample_imnet', 'model': 'resnet18_imnet_mvm', 'ind': ind, 'data': args.data,
+                      'weights': state_dict_hash(model_mvm), 'layers': mvm_layer_config(model_mvm)}
+        results = EvalResultsLog(args.results, cfg.config_hash(run_config))
+        print('==> Results log', args.results, 'config', results.config, ':', len(results.results), 'finished batches')
     if len(args.cuda_gpu)>1:
         model = torch.nn.DataParallel(model.cuda(), device_ids=[0])
         model_mvm = torch.nn.DataParallel(model_mvm.cuda(), device_ids=[0])
@@ -321,6 +363,21 @@ if __name__=='__main__':
     print('Data Loading done')
     criterion = nn.CrossEntropyLoss()
 
+    if args.procs > 1:
+        if device.type != 'cpu':
+            raise Exception('--procs is for CPU evaluation, CUDA cannot be used in forked workers')
+        test_shards = shard_dataset(testloader.dataset, args.procs, args.batch_size)
+        with mp.get_context('fork').Pool(len(test_shards)) as pool:
+            shard_meters = pool.map(test_mvm_shard, range(len(test_shards)), chunksize=1)
+        losses, top1, top5 = shard_meters[0]
+        for meters in shard_meters[1:]:
+            losses.merge(meters[0])
+            top1.merge(meters[1])
+            top5.merge(meters[2])
+        print(' * {0} processes: Loss {loss.avg:.4f} Prec@1 {top1.avg:.3f} Prec@5 {top5.avg:.3f}'
+              .format(len(test_shards), loss=losses, top1=top1, top5=top5))
+        exit(0)
+
     if args.evaluate:
         test()
         test_mvm()
@@ -1,6 +1,9 @@
 import os
+import json
+import hashlib
 import torch
 import logging.config
+import src.config as cfg
 import shutil
 import pandas as pd
 #import matplotlib.pyplot as plt
@@ -103,6 +106,105 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def merge(self, other):
+        """Adds the samples of another meter (e.g. of a parallel evaluation worker)"""
+        self.sum += other.sum
+        self.count += other.count
+        self.avg = self.sum / self.count if self.count > 0 else 0
+
+
+def shard_dataset(dataset, num_shards, batch_size):
+    """Splits a dataset into at most num_shards contiguous shards of whole mini-batches,
+    so every shard evaluates the same mini-batches as a serial run
+    """
+    num_batches = (len(dataset) + batch_size - 1) // batch_size
+    shard_size = (num_batches + num_shards - 1) // num_shards * batch_size
+    return [torch.utils.data.Subset(dataset, range(start, min(start + shard_size, len(dataset))))
+            for start in range(0, len(dataset), shard_size)]
+
+
+def setup_eval_worker(rank, num_workers, threads=0):
+    """Pins evaluation worker rank to its intra-op thread count (threads <= 0: an equal share
+    of the available cores) and, where the OS supports it, to its own cores
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if threads <= 0:
+        threads = max(1, len(cores) // num_workers)
+    torch.set_num_threads(threads)
+    if hasattr(os, 'sched_setaffinity') and len(cores) >= threads * num_workers:
+        os.sched_setaffinity(0, cores[rank * threads:(rank + 1) * threads])
+    return threads
+
+
+def state_dict_hash(model):
+    """Hash of the parameters and buffers of a model"""
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def mvm_layer_config(model):
+    """Simulator settings of the Conv2d_mvm/Linear_mvm layers of a model (bit widths, ADC, tiles, GENIEx checkpoint)"""
+    return [[name, type(m).__name__] + cfg.layer_settings(m)
+            for name, m in model.named_modules() if hasattr(m, 'xbar_cache')]
+
+
+class EvalResultsLog(object):
+    """Append-only log (JSON lines) of per-batch evaluation results: top-5 predictions, targets,
+    loss and precision. Batches are keyed by the config hash and the dataset index of their first
+    sample, so a restarted evaluation replays the finished batches instead of recomputing them.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.readlines()
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # partial line of an interrupted write
+                    continue
+                if record.get('config') == config:
+                    self.results[(record['index'], record['n'])] = record
+            if lines and not lines[-1].endswith('\n'):
+                self._write('\n')
+
+    def _write(self, line):
+        # one O_APPEND write per record: concurrent evaluation workers can share the file
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def batch_index(loader, batch_idx):
+        """Dataset index of the first sample of mini-batch batch_idx of an unshuffled loader"""
+        start = batch_idx * loader.batch_size
+        if isinstance(loader.dataset, torch.utils.data.Subset):
+            return int(loader.dataset.indices[start])
+        return start
+
+    def get(self, loader, batch_idx, n):
+        return self.results.get((self.batch_index(loader, batch_idx), n))
+
+    def append(self, loader, batch_idx, output, target, loss, prec1, prec5):
+        record = {'config': self.config, 'index': self.batch_index(loader, batch_idx), 'n': target.size(0),
+                  'pred': output.topk(min(5, output.size(1)), 1)[1].tolist(), 'target': target.tolist(),
+                  'loss': float(loss), 'prec1': float(prec1), 'prec5': float(prec5)}
+        self._write(json.dumps(record) + '\n')
+        self.results[(record['index'], record['n'])] = record
+        return record
+
 __optimizers = {
     'SGD': torch.optim.SGD,
     'ASGD': torch.optim.ASGD,